@@ -11,23 +11,35 @@
 
 import asyncio
 import configparser
+import dataclasses
+import functools
 import logging
 import os
+import queue
 import random
 import re
 import sqlite3
-import time
-from datetime import datetime, timezone
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 
 from google import genai
 from telegram import (
+    Audio,
+    Document,
     Message,
     MessageOrigin,
     MessageOriginChannel,
     MessageOriginChat,
     MessageOriginHiddenUser,
     MessageOriginUser,
+    Sticker,
     Update,
+    Video,
+    VideoNote,
+    Voice,
 )
 from telegram.error import TelegramError
 from telegram.ext import Application, ContextTypes, MessageHandler, filters
@@ -37,53 +49,108 @@ from markdown_converter import markdown_to_telegram_html
 
 
 # --- ЧТЕНИЕ НАСТРОЕК ---
-def load_config(config_path="config.cfg"):
+@dataclass(frozen=True, slots=True)
+class Config:  # pylint: disable=too-many-instance-attributes
+    """Настройки бота. Имена ключей в config.cfg и в окружении - имена полей в верхнем регистре."""
+
+    bot_token: str
+    gemini_api_key: str
+    db_file: str
+    media_dir: str
+    trigger_word: str
+    system_prompt: str
+    model: str
+    # Необязательные параметры: у старых конфигов их нет, поэтому с запасными значениями.
+    max_context_tokens: int = 200_000
+    google_search: bool = True
+    max_context_messages: int = 5000
+    retention_days: int = 0
+
+
+def parse_config_value(raw: str, kind: type):
+    """
+    Приводит строку из файла или окружения к типу поля Config.
+
+    :param raw: значение как оно записано
+    :type raw: str
+    :param kind: тип поля (str, int или bool)
+    :type kind: type
+    :return: значение нужного типа
+    :raises ValueError: если строку не получается прочитать как число или флаг
+    """
+    if kind is bool:
+        try:
+            return configparser.ConfigParser.BOOLEAN_STATES[raw.strip().lower()]
+        except KeyError as e:
+            raise ValueError(f"Не похоже на true/false: {raw!r}") from e
+    if kind is int:
+        return int(raw)
+    return raw
+
+
+def load_config(config_path="config.cfg") -> Config:
     """
-    Загружает настройки из конфигурационного файла (UTF-8).
+    Загружает настройки из конфигурационного файла (UTF-8) и переменных окружения.
+
+    Переменная окружения с именем ключа (BOT_TOKEN, GEMINI_API_KEY, ...) перекрывает
+    значение из файла. Так ключи можно держать вне config.cfg, а если все обязательные
+    заданы в окружении, файл не нужен вовсе.
 
     Args:
         config_path (str): Путь к файлу конфигурации.
 
     Returns:
-        dict: Словарь с настройками.
+        Config: Настройки бота.
     """
-    if not os.path.exists(config_path):
-        raise FileNotFoundError(f"Файл конфигурации не найден: {config_path}")
-
     config = configparser.ConfigParser()
-    with open(config_path, "r", encoding="utf-8") as f:
-        config.read_file(f)
-
-    settings = {
-        "BOT_TOKEN": config.get("SETTINGS", "BOT_TOKEN"),
-        "GEMINI_API_KEY": config.get("SETTINGS", "GEMINI_API_KEY"),
-        "DB_FILE": config.get("SETTINGS", "DB_FILE"),
-        "MEDIA_DIR": config.get("SETTINGS", "MEDIA_DIR"),
-        "TRIGGER_WORD": config.get("SETTINGS", "TRIGGER_WORD"),
-        "SYSTEM_PROMPT": config.get("SETTINGS", "SYSTEM_PROMPT"),
-        "MODEL": config.get("SETTINGS", "MODEL"),
-        # Необязательные параметры: у старых конфигов их нет, поэтому с запасными значениями.
-        "MAX_CONTEXT_TOKENS": config.getint(
-            "SETTINGS", "MAX_CONTEXT_TOKENS", fallback=200_000
-        ),
-        "GOOGLE_SEARCH": config.getboolean("SETTINGS", "GOOGLE_SEARCH", fallback=True),
-    }
+    if os.path.exists(config_path):
+        with open(config_path, "r", encoding="utf-8") as f:
+            config.read_file(f)
+    section = config["SETTINGS"] if config.has_section("SETTINGS") else {}
+
+    values = {}
+    missing = []
+    for field in dataclasses.fields(Config):
+        key = field.name.upper()
+        raw = os.environ.get(key, section.get(key))
+        if raw is not None:
+            values[field.name] = parse_config_value(raw, field.type)
+        elif field.default is dataclasses.MISSING:
+            missing.append(key)
 
-    return settings
+    if missing:
+        if not os.path.exists(config_path):
+            raise FileNotFoundError(f"Файл конфигурации не найден: {config_path}")
+        raise ValueError(f"В {config_path} не заданы параметры: {', '.join(missing)}")
+
+    return Config(**values)
 
 
 # Загружаем настройки
-FILE_UPLOAD_DELAY_PER_MB = 0.6
 CONFIG = load_config()
-BOT_TOKEN = CONFIG["BOT_TOKEN"]
-GEMINI_API_KEY = CONFIG["GEMINI_API_KEY"]
-DB_FILE = CONFIG["DB_FILE"]
-MEDIA_DIR = CONFIG["MEDIA_DIR"]
-TRIGGER_WORD = CONFIG["TRIGGER_WORD"]
-SYSTEM_PROMPT = CONFIG["SYSTEM_PROMPT"]
-MODEL = CONFIG["MODEL"]
-MAX_CONTEXT_TOKENS = CONFIG["MAX_CONTEXT_TOKENS"]
-GOOGLE_SEARCH = CONFIG["GOOGLE_SEARCH"]
+BOT_TOKEN = CONFIG.bot_token
+GEMINI_API_KEY = CONFIG.gemini_api_key
+DB_FILE = CONFIG.db_file
+MEDIA_DIR = CONFIG.media_dir
+TRIGGER_WORD = CONFIG.trigger_word
+SYSTEM_PROMPT = CONFIG.system_prompt
+MODEL = CONFIG.model
+MAX_CONTEXT_TOKENS = CONFIG.max_context_tokens
+GOOGLE_SEARCH = CONFIG.google_search
+# Потолок несжатых сообщений, которые читаем из БД на один ответ. Длину контекста держит
+# сжатие, это только страховка, чтобы запрос к БД не рос вместе со всей историей. Если
+# потолок все же достигнут, не влезшие сообщения не теряются: они остаются несжатыми и
+# вернутся в контекст, когда сжатие освободит место.
+MAX_CONTEXT_MESSAGES = CONFIG.max_context_messages
+# Сколько дней хранить сообщения, уже вошедшие в пересказ. 0 - хранить всегда. Несжатые
+# сообщения не удаляются никогда: без них контекст потерял бы еще не пересказанное.
+RETENTION_DAYS = CONFIG.retention_days
+# Триггер ищется только в начале сообщения, поэтому к нижнему регистру приводим только
+# этот кусок, а не весь текст - он может быть длиной в тысячи символов.
+TRIGGER_PREFIX = TRIGGER_WORD.lower()
+TRIGGER_LENGTH = len(TRIGGER_WORD)
+# Чаты, в которых бот работает. Каналы сюда не входят.
+ALLOWED_CHAT_TYPES = frozenset({"group", "supergroup", "private"})
 
 # --- ПОИСК В ГУГЛЕ ---
 # Инструмент поиска модель вызывает сама, на своей стороне: решает, нужны ли ей свежие
@@ -98,6 +165,25 @@ REPLY_CONFIG = (
     else None
 )
 
+# --- НАСТРОЙКИ ВЛОЖЕНИЙ ---
+# Файлы больше этого в Gemini не отправляем.
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+# Файлы больше этого из Telegram не качаем. Bot API и сам не отдает файлы больше 20 МБ,
+# но размер известен заранее: отказать можно сразу, не спрашивая Telegram.
+MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+# Сорвавшуюся загрузку пробуем снова не раньше, чем через столько. Иначе сообщение
+# с недоступным файлом, пока оно в контексте, стоило бы запроса к Telegram на каждом ответе.
+DOWNLOAD_RETRY_DELAY = timedelta(minutes=30)
+# Столько вложений одновременно проверяем и выгружаем в Gemini. Больше не надо: выгрузки
+# делят один канал, а лишние параллельные запросы только приближают лимит API.
+UPLOAD_CONCURRENCY = 4
+# Столько выгруженных файлов помним в памяти. Остальные при нужде поднимаются по имени
+# из БД одним запросом к API.
+UPLOADED_FILES_LIMIT = 1024
+# Выгруженный файл живет в Gemini до своего expiration_time. Пока до него дальше этого
+# запаса, файл из памяти берем без проверки через API: сам по себе он не пропадает.
+FILE_EXPIRY_MARGIN = timedelta(hours=1)
+
 # --- НАСТРОЙКИ ПОВТОРНЫХ ПОПЫТОК ---
 # Сколько раз пробуем получить от модели корректный текст, прежде чем сдаться.
 MAX_RETRIES = 15
@@ -183,6 +269,73 @@ SERVICE_NOTE_PATTERN = re.compile(
     rf"^\s*\[(?:{FORWARD_NOTE_LEAD}|{REPLY_NOTE_LEAD}|{QUOTE_NOTE_LEAD})[^\n]*\]\s*"
 )
 
+# --- НАСТРОЙКИ ЗАПИСИ В БД ---
+# Обработчик не пишет в БД сам: новые сообщения уходят в очередь (bot_data["write_queue"]),
+# а фоновая задача забирает из нее все, что накопилось, и пишет одной транзакцией в
+# отдельном потоке. Пока идет запись, очередь копит следующую пачку, поэтому под нагрузкой
+# коммитов намного меньше, чем сообщений. Перед чтением контекста обработчик
+# дожидается записи своего сообщения (future из очереди), а не всей очереди.
+# Больше стольких сообщений в одну транзакцию не берем.
+COMMIT_BATCH_SIZE = 50
+# Пишущее соединение одно на весь бот (check_same_thread=False), а пишут в него из потока
+# фоновой задачи. Поэтому все записи - под этой блокировкой, чтобы транзакции не
+# перемешались.
+DB_LOCK = threading.Lock()
+# Контекст читается через отдельные соединения из пула, в потоках. В WAL читатели не
+# мешают ни писателю, ни друг другу, и ответ в одном чате не ждет записи в другом.
+READ_POOL_SIZE = 4
+# Раз во столько секунд фоновая задача чистит старые сообщения (если задан RETENTION_DAYS)
+# и сбрасывает WAL в основной файл, чтобы журнал не разрастался.
+MAINTENANCE_INTERVAL = 3600
+# Запрос один на все сообщения, держим его константой и отдаем в executemany целой пачкой.
+# Правка сообщения обновляет строку на месте: REPLACE удалял бы ее и вставлял заново со
+# свежим id, теряя summarized и gemini_file_name. Игнорировать повтор (DO NOTHING) тоже
+# нельзя - пропали бы правки. Поэтому строку трогаем, только если в ней что-то поменялось:
+# повторно доставленное Telegram сообщение не переписывает ни строку, ни индекс.
+# message_id уникален только в пределах чата, а UNIQUE в схеме - на нем одном: если тот же
+# номер пришел из другого чата, это другое сообщение, и признак сжатия ему не достается.
+# Выгруженный в Gemini файл остается только при том же file_id: новое вложение в правке
+# или в чужом сообщении надо выгрузить заново.
+INSERT_MESSAGE_SQL = """
+    INSERT INTO messages (
+        message_id, chat_id, user_id, username, content, media_type,
+        mime_type, file_id, file_name, timestamp, reply_to_message_id,
+        quote_text, forward_origin, is_bot
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (message_id) DO UPDATE SET
+        chat_id = excluded.chat_id,
+        user_id = excluded.user_id,
+        username = excluded.username,
+        content = excluded.content,
+        media_type = excluded.media_type,
+        mime_type = excluded.mime_type,
+        file_id = excluded.file_id,
+        file_name = excluded.file_name,
+        timestamp = excluded.timestamp,
+        reply_to_message_id = excluded.reply_to_message_id,
+        quote_text = excluded.quote_text,
+        forward_origin = excluded.forward_origin,
+        is_bot = excluded.is_bot,
+        summarized = CASE
+            WHEN messages.chat_id IS excluded.chat_id THEN messages.summarized
+            ELSE 0
+        END,
+        gemini_file_name = CASE
+            WHEN messages.file_id IS excluded.file_id THEN messages.gemini_file_name
+        END
+    WHERE (
+        messages.chat_id, messages.user_id, messages.username, messages.content,
+        messages.media_type, messages.mime_type, messages.file_id, messages.file_name,
+        messages.timestamp, messages.reply_to_message_id, messages.quote_text,
+        messages.forward_origin, messages.is_bot
+    ) IS NOT (
+        excluded.chat_id, excluded.user_id, excluded.username, excluded.content,
+        excluded.media_type, excluded.mime_type, excluded.file_id, excluded.file_name,
+        excluded.timestamp, excluded.reply_to_message_id, excluded.quote_text,
+        excluded.forward_origin, excluded.is_bot
+    )
+"""
+
 # --- ЛОГИРОВАНИЕ ---
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -200,8 +353,22 @@ def init_db():
         sqlite3.Connection: Соединение с базой данных.
     """
     os.makedirs(MEDIA_DIR, exist_ok=True)
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    with os.scandir(MEDIA_DIR) as entries:
+        present_files.update(
+            (entry.name, entry.stat().st_size) for entry in entries if entry.is_file()
+        )
+    # isolation_level=None: модуль sqlite3 сам транзакций не открывает. Одиночные запросы
+    # коммитятся сразу, а пачки записей идут в явных BEGIN IMMEDIATE ... COMMIT.
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
+    # WAL с synchronous=NORMAL делает fsync только на чекпоинтах, а не на каждый коммит.
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-20000")
+    cursor.execute("PRAGMA busy_timeout=5000")
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -219,7 +386,8 @@ def init_db():
             quote_text TEXT,
             forward_origin TEXT,
             is_bot BOOLEAN DEFAULT 0,
-            summarized INTEGER DEFAULT 0
+            summarized INTEGER DEFAULT 0,
+            gemini_file_name TEXT
         )
     """)
     # Пересказы сжатых кусков истории. Сами сообщения остаются в messages, но в контекст
@@ -229,34 +397,193 @@ def init_db():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             summary TEXT,
             covered_messages INTEGER,
-            created_at TEXT
+            created_at TEXT,
+            chat_id INTEGER
         )
     """)
     add_missing_columns(cursor)
-    conn.commit()
+    load_downloaded_file_ids(cursor)
+    # Прошлые версии писали местное время без смещения. Переводим его в UTC в том же
+    # формате, что пишется сейчас, иначе старые и новые строки сортировались бы вперемешку.
+    cursor.execute("""
+        UPDATE messages
+        SET timestamp = strftime('%Y-%m-%dT%H:%M:%S+00:00', timestamp, 'utc')
+        WHERE timestamp NOT LIKE '%+%'
+    """)
+    # Контекст читается по чату от свежих к старым и только из несжатой части истории.
+    # Частичный индекс покрывает ровно ее: сжатые сообщения из него выпадают.
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_msg_chat_ts
+        ON messages (chat_id, timestamp DESC, message_id DESC)
+        WHERE summarized = 0
+    """)
+    # Имя файла в Gemini пишется во все сообщения с тем же file_id, а при запуске
+    # load_downloaded_file_ids перебирает сообщения с файлами. Без индекса оба запроса
+    # сканировали бы всю таблицу, причем UPDATE - под DB_LOCK, задерживая запись.
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_msg_file_id
+        ON messages (file_id)
+        WHERE file_id IS NOT NULL
+    """)
     return conn
 
 
-# Колонки messages, которых нет в базах, созданных прошлыми версиями бота.
-LATE_MESSAGE_COLUMNS = {
-    "summarized": "INTEGER DEFAULT 0",
-    "quote_text": "TEXT",
-    "forward_origin": "TEXT",
+# Свободные соединения для чтения. Пополняется open_read_pool.
+read_pool = queue.Queue()
+
+
+def open_read_pool():
+    """
+    Открывает READ_POOL_SIZE соединений только для чтения. Вызывать после init_db:
+    схема и режим WAL к этому моменту уже в файле.
+    """
+    for _ in range(READ_POOL_SIZE):
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only=ON")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA cache_size=-20000")
+        conn.execute("PRAGMA busy_timeout=5000")
+        read_pool.put(conn)
+
+
+def close_read_pool():
+    """Закрывает все соединения пула."""
+    while True:
+        try:
+            read_pool.get_nowait().close()
+        except queue.Empty:
+            return
+
+
+@contextmanager
+def borrow_read_connection():
+    """
+    Берет свободное соединение из пула на время блока и возвращает его обратно.
+
+    :return: соединение только для чтения
+    :rtype: sqlite3.Connection
+    """
+    conn = read_pool.get()
+    try:
+        yield conn
+    finally:
+        read_pool.put(conn)
+
+
+# Колонки, которых нет в базах, созданных прошлыми версиями бота.
+LATE_COLUMNS = {
+    "messages": {
+        "summarized": "INTEGER DEFAULT 0",
+        "quote_text": "TEXT",
+        "forward_origin": "TEXT",
+        "gemini_file_name": "TEXT",
+    },
+    # У пересказов из старых баз чата нет: они остаются общими для всех чатов.
+    "context_summaries": {
+        "chat_id": "INTEGER",
+    },
 }
 
 
 def add_missing_columns(cursor: sqlite3.Cursor):
     """
-    Дописывает в messages колонки, появившиеся после создания базы.
+    Дописывает в таблицы колонки, появившиеся после создания базы.
 
     :param cursor: курсор открытой базы
     :type cursor: sqlite3.Cursor
     """
-    columns = {row[1] for row in cursor.execute("PRAGMA table_info(messages)")}
-    for name, definition in LATE_MESSAGE_COLUMNS.items():
-        if name not in columns:
-            cursor.execute(f"ALTER TABLE messages ADD COLUMN {name} {definition}")
-            logger.info("В таблицу messages добавлена колонка %s.", name)
+    for table, late_columns in LATE_COLUMNS.items():
+        columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+        for name, definition in late_columns.items():
+            if name not in columns:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+                logger.info("В таблицу %s добавлена колонка %s.", table, name)
+
+
+def write_messages(conn: sqlite3.Connection, rows: list):
+    """
+    Записывает пачку сообщений в БД одной транзакцией.
+
+    :param conn: соединение с базой данных
+    :type conn: sqlite3.Connection
+    :param rows: строки для INSERT_MESSAGE_SQL
+    :type rows: list
+    """
+    with DB_LOCK:
+        conn.execute("BEGIN IMMEDIATE")
+        # Откатываем на любом выходе, включая сбой самого COMMIT: иначе соединение
+        # останется в транзакции, и каждый следующий BEGIN IMMEDIATE на нем упадет.
+        try:
+            conn.executemany(INSERT_MESSAGE_SQL, rows)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    logger.info("Записано в БД сообщений: %d.", len(rows))
+
+
+async def run_db_writer(conn: sqlite3.Connection, write_queue: asyncio.Queue):
+    """
+    Фоновая задача: забирает сообщения из очереди и пишет их в БД пачками.
+
+    В очереди лежат пары (строка, future). Future получает True, когда строка легла в
+    БД, и False, если записать ее не удалось: так обработчик ждет только свою запись.
+
+    :param conn: соединение с базой данных
+    :type conn: sqlite3.Connection
+    :param write_queue: очередь пар (строка для INSERT_MESSAGE_SQL, asyncio.Future)
+    :type write_queue: asyncio.Queue
+    """
+    while True:
+        batch = [await write_queue.get()]
+        while len(batch) < COMMIT_BATCH_SIZE:
+            try:
+                batch.append(write_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        try:
+            await write_batch(conn, batch)
+        finally:
+            for _ in batch:
+                write_queue.task_done()
+
+
+async def write_batch(conn: sqlite3.Connection, batch: list):
+    """
+    Пишет пачку из очереди и сообщает каждому ожидающему, легла ли его строка.
+
+    Если пачка не легла целиком, строки пишутся по одной: одна испорченная строка
+    (например, текст с одиночным суррогатом) не должна утянуть за собой остальные.
+
+    :param conn: соединение с базой данных
+    :type conn: sqlite3.Connection
+    :param batch: пары (строка для INSERT_MESSAGE_SQL, asyncio.Future)
+    :type batch: list
+    """
+    # Ловим любое исключение: задача должна жить дальше, иначе перестанут записываться
+    # и новые сообщения, а ждущие своей записи обработчики повиснут.
+    try:
+        await asyncio.to_thread(write_messages, conn, [row for row, _ in batch])
+        results = [True] * len(batch)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        if len(batch) == 1:
+            logger.error("Не удалось записать сообщение в БД: %s", e)
+            results = [False]
+        else:
+            results = []
+            for row, _ in batch:
+                try:
+                    await asyncio.to_thread(write_messages, conn, [row])
+                    results.append(True)
+                except Exception as row_error:  # pylint: disable=broad-exception-caught
+                    logger.error(
+                        "Не удалось записать сообщение %s в БД: %s", row[0], row_error
+                    )
+                    results.append(False)
+    for (_, written), ok in zip(batch, results):
+        if not written.done():
+            written.set_result(ok)
 
 
 def build_author_tag(name: str, username: str | None, date: str) -> str:
@@ -339,13 +666,13 @@ def shorten(text: str, limit: int) -> str:
     return single_line[:limit].rstrip() + "…"
 
 
-def describe_reply_target(target: dict | None) -> str:
+def describe_reply_target(target: sqlite3.Row | None) -> str:
     """
     Описывает сообщение, на которое отвечают: чье оно и с чего начиналось.
 
-    :param target: строка таблицы messages в виде словаря или None, если адресата
+    :param target: строка адресата из attach_reply_targets или None, если адресата
         не нашлось в базе
-    :type target: dict | None
+    :type target: sqlite3.Row | None
     :return: описание адресата для служебной пометки
     :rtype: str
     """
@@ -353,18 +680,16 @@ def describe_reply_target(target: dict | None) -> str:
         # Отвечать могут и на сообщение старше бота: его в базе нет и уже не будет.
         return "сообщение, которого нет в истории"
 
-    author = (
-        "бота" if target.get("is_bot") else f'"{target.get("username") or "unknown"}"'
-    )
-    snippet = shorten(target.get("content") or "", REPLY_SNIPPET_LIMIT)
+    author = "бота" if target["is_bot"] else f'"{target["username"] or "unknown"}"'
+    snippet = shorten(target["content"] or "", REPLY_SNIPPET_LIMIT)
     description = f"сообщение {author}"
     # У пересланного адресата автор подписи - тот, кто переслал, а слова в нем чужие.
-    forwarded = target.get("forward_origin")
+    forwarded = target["forward_origin"]
     if forwarded:
         description += f" (переслано {forwarded})"
     if snippet:
         description += f": «{snippet}»"
-    media_type = target.get("media_type")
+    media_type = target["media_type"]
     if media_type:
         description += f" [вложение: {media_type}]"
     return description
@@ -438,8 +763,70 @@ def build_service_note(msg: dict) -> str | None:
     return f"[{'. '.join(notes)}]" if notes else None
 
 
-def save_message_to_db(  # pylint: disable=too-many-locals
-    conn: sqlite3.Connection,
+def extract_photo(photo: tuple) -> tuple:
+    """Берет самый крупный размер фото."""
+    return "photo", photo[-1].file_id, "image/jpeg", None, photo[-1].file_size
+
+
+def extract_document(document: Document) -> tuple:
+    """Документ приходит со своим MIME-типом и именем файла."""
+    return (
+        "document",
+        document.file_id,
+        document.mime_type,
+        document.file_name,
+        document.file_size,
+    )
+
+
+def extract_sticker(sticker: Sticker) -> tuple:
+    """Обычный стикер - картинка webp, анимированный и видеостикер - webm."""
+    static = not sticker.is_animated and not sticker.is_video
+    mime_type = "image/webp" if static else "video/webm"
+    return "sticker", sticker.file_id, mime_type, None, sticker.file_size
+
+
+def extract_video(video: Video) -> tuple:
+    """Видео приходит со своим MIME-типом и именем файла."""
+    return "video", video.file_id, video.mime_type, video.file_name, video.file_size
+
+
+def extract_audio(audio: Audio) -> tuple:
+    """Аудио приходит со своим MIME-типом и именем файла."""
+    return "audio", audio.file_id, audio.mime_type, audio.file_name, audio.file_size
+
+
+def extract_voice(voice: Voice) -> tuple:
+    """Голосовые Telegram всегда пишет в ogg."""
+    return "audio", voice.file_id, "audio/ogg", None, voice.file_size
+
+
+def extract_video_note(video_note: VideoNote) -> tuple:
+    """Кружки Telegram всегда пишет в mp4."""
+    return "video", video_note.file_id, "video/mp4", None, video_note.file_size
+
+
+# Поле сообщения с вложением -> функция, достающая из него
+# (media_type, file_id, mime_type, file_name, file_size). У сообщения не больше одного
+# вложения, проверяем по порядку до первого найденного.
+MEDIA_EXTRACTORS = (
+    ("photo", extract_photo),
+    ("document", extract_document),
+    ("sticker", extract_sticker),
+    ("video", extract_video),
+    ("audio", extract_audio),
+    ("voice", extract_voice),
+    ("video_note", extract_video_note),
+)
+# Голосовые и кружки текста не несут: вместо него в контекст идет пометка с автором.
+MEDIA_CONTENT_NOTES = {
+    "voice": "[Голосовое сообщение by {}]",
+    "video_note": "[Видео сообщение by {}]",
+}
+
+
+async def save_message_to_db(  # pylint: disable=too-many-locals
+    write_queue: asyncio.Queue,
     message: Message,
     is_bot: bool = False,
     content_override: str | None = None,
@@ -447,8 +834,10 @@ def save_message_to_db(  # pylint: disable=too-many-locals
     """
     Сохраняет сообщение в базу данных.
 
+    Сообщение встает в очередь на запись: в БД его положит run_db_writer.
+
     Args:
-        conn (sqlite3.Connection): Соединение с базой данных.
+        write_queue (asyncio.Queue): Очередь на запись в БД.
         message (Message): Объект сообщения Telegram.
         is_bot (bool, optional): Флаг, указывающий, является ли сообщение от бота.
         По умолчанию False.
@@ -456,62 +845,35 @@ def save_message_to_db(  # pylint: disable=too-many-locals
         реального текста сообщения. Нужен, чтобы простыня с ошибкой API не засоряла историю.
 
     Returns:
-        tuple: (file_id, mime_type, file_name) - информация о медиа-файле, если он присутствует.
+        tuple: (file_id, mime_type, file_name, file_size, written) - информация о
+        медиа-файле, если он присутствует, и future, которая завершится, когда
+        run_db_writer запишет сообщение (True) или не сможет его записать (False).
+        file_size Telegram сообщает не всегда.
     """
-    cursor = conn.cursor()
     content = message.text or message.caption or ""
 
-    media_type, mime_type, file_id, file_name = None, None, None, None
+    media_type, mime_type, file_id, file_name, file_size = None, None, None, None, None
 
-    if message.photo:
-        media_type, file_id, mime_type = (
-            "photo",
-            message.photo[-1].file_id,
-            "image/jpeg",
-        )
-    elif message.document:
-        media_type, file_id, mime_type, file_name = (
-            "document",
-            message.document.file_id,
-            message.document.mime_type,
-            message.document.file_name,
-        )
-    elif message.sticker:
-        media_type, file_id = "sticker", message.sticker.file_id
-        mime_type = (
-            "image/webp"
-            if not message.sticker.is_animated and not message.sticker.is_video
-            else "video/webm"
-        )
-    elif message.video:
-        media_type, file_id, mime_type, file_name = (
-            "video",
-            message.video.file_id,
-            message.video.mime_type,
-            message.video.file_name,
-        )
-    elif message.audio:
-        media_type, file_id, mime_type, file_name = (
-            "audio",
-            message.audio.file_id,
-            message.audio.mime_type,
-            message.audio.file_name,
-        )
-    elif message.voice:
-        media_type, file_id, mime_type = "audio", message.voice.file_id, "audio/ogg"
-        content = f"[Голосовое сообщение by {message.from_user.username}]"
-    elif message.video_note:
-        media_type, file_id, mime_type = (
-            "video",
-            message.video_note.file_id,
-            "video/mp4",
-        )
-        content = f"[Видео сообщение by {message.from_user.username}]"
+    # У текстового сообщения вложений не бывает (у медиа вместо текста подпись), а это
+    # самый частый случай - перебирать для него все виды вложений незачем.
+    if message.text is None:
+        for attr, extract in MEDIA_EXTRACTORS:
+            attachment = getattr(message, attr)
+            if attachment:
+                media_type, file_id, mime_type, file_name, file_size = extract(
+                    attachment
+                )
+                if attr in MEDIA_CONTENT_NOTES:
+                    content = MEDIA_CONTENT_NOTES[attr].format(
+                        message.from_user.username
+                    )
+                break
 
     if content_override is not None:
         content = content_override
 
-    timestamp = datetime.fromtimestamp(message.date.timestamp()).isoformat()
+    # Время в UTC с явным смещением: строки одного формата сортируются как время.
+    timestamp = message.date.astimezone(timezone.utc).isoformat()
     reply_to_id = (
         message.reply_to_message.message_id if message.reply_to_message else None
     )
@@ -535,55 +897,101 @@ def save_message_to_db(  # pylint: disable=too-many-locals
     else:
         user_prompt = "Bot"
 
-    cursor.execute(
-        """
-        INSERT OR REPLACE INTO messages (
-            message_id, chat_id, user_id, username, content, media_type,
-            mime_type, file_id, file_name, timestamp, reply_to_message_id,
-            quote_text, forward_origin, is_bot
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """,
+    # Правка меняет текст реплики, а значит и ее готовые части запроса.
+    forget_message_parts(message.chat_id, message.message_id, bool(message.edit_date))
+    written = asyncio.get_running_loop().create_future()
+    await write_queue.put(
         (
-            message.message_id,
-            message.chat_id,
-            user_id,
-            user_prompt,
-            content,
-            media_type,
-            mime_type,
-            file_id,
-            file_name,
-            timestamp,
-            reply_to_id,
-            quote_text,
-            forward_origin,
-            is_bot,
-        ),
+            (
+                message.message_id,
+                message.chat_id,
+                user_id,
+                user_prompt,
+                content,
+                media_type,
+                mime_type,
+                file_id,
+                file_name,
+                timestamp,
+                reply_to_id,
+                quote_text,
+                forward_origin,
+                is_bot,
+            ),
+            written,
+        )
     )
-    conn.commit()
-    logger.info("Сохранено сообщение %s в БД.", message.message_id)  # lazy logging
-    return file_id, mime_type, file_name
+    logger.info("Сообщение %s ждет записи в БД.", message.message_id)  # lazy logging
+    return file_id, mime_type, file_name, file_size, written
 
 
-def get_latest_summary(conn: sqlite3.Connection) -> str | None:
+def prune_database(conn: sqlite3.Connection):
     """
-    Возвращает последний пересказ сжатой части истории.
+    Удаляет сжатые сообщения старше RETENTION_DAYS и обрезает WAL.
+
+    :param conn: соединение с базой данных
+    :type conn: sqlite3.Connection
+    """
+    with DB_LOCK:
+        if RETENTION_DAYS > 0:
+            cutoff = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(
+                days=RETENTION_DAYS
+            )
+            deleted = conn.execute(
+                "DELETE FROM messages WHERE summarized = 1 AND timestamp < ?",
+                (cutoff.isoformat(),),
+            ).rowcount
+            if deleted:
+                logger.info("Удалено старых сообщений: %d.", deleted)
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+async def maintain_database(conn: sqlite3.Connection):
+    """
+    Фоновая задача: раз в MAINTENANCE_INTERVAL секунд вызывает prune_database.
+
+    :param conn: соединение с базой данных
+    :type conn: sqlite3.Connection
+    """
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        try:
+            await asyncio.to_thread(prune_database, conn)
+        except sqlite3.Error as e:
+            logger.error("Не удалось обслужить БД: %s", e)
+
+
+def get_latest_summary(conn: sqlite3.Connection, chat_id: int) -> str | None:
+    """
+    Возвращает последний пересказ сжатой части истории чата.
 
     Каждый следующий пересказ вбирает в себя предыдущий, поэтому актуален всегда
-    только самый свежий.
+    только самый свежий. Пересказ без чата остался от версий бота, которые вели одну
+    общую историю: он годится любому чату, пока у того не появится свой.
 
     :param conn: соединение с базой данных
     :type conn: sqlite3.Connection
+    :param chat_id: идентификатор чата
+    :type chat_id: int
     :return: текст пересказа или None, если сжатия еще не было
     :rtype: str | None
     """
     cursor = conn.cursor()
-    cursor.execute("SELECT summary FROM context_summaries ORDER BY id DESC LIMIT 1")
+    cursor.execute(
+        """
+        SELECT summary FROM context_summaries
+        WHERE chat_id = ? OR chat_id IS NULL
+        ORDER BY id DESC LIMIT 1
+    """,
+        (chat_id,),
+    )
     row = cursor.fetchone()
     return row[0] if row else None
 
 
-def save_summary(conn: sqlite3.Connection, summary: str, message_ids: list):
+def save_summary(
+    conn: sqlite3.Connection, chat_id: int, summary: str, message_ids: list
+):
     """
     Сохраняет пересказ и помечает вошедшие в него сообщения как сжатые.
 
@@ -593,36 +1001,83 @@ def save_summary(conn: sqlite3.Connection, summary: str, message_ids: list):
 
     :param conn: соединение с базой данных
     :type conn: sqlite3.Connection
+    :param chat_id: чат, историю которого пересказали
+    :type chat_id: int
     :param summary: текст пересказа
     :type summary: str
     :param message_ids: message_id сообщений, вошедших в пересказ
     :type message_ids: list
     """
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        INSERT INTO context_summaries (summary, covered_messages, created_at)
-        VALUES (?, ?, ?)
+    with DB_LOCK:
+        cursor = conn.cursor()
+        # Пересказ и пометки - одна транзакция: без пометок сжатое попало бы в контекст
+        # дважды, без пересказа - пропало бы.
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute(
+                """
+        INSERT INTO context_summaries (summary, covered_messages, created_at, chat_id)
+        VALUES (?, ?, ?, ?)
     """,
-        (summary, len(message_ids), datetime.now(timezone.utc).isoformat()),
-    )
-    cursor.executemany(
-        "UPDATE messages SET summarized = 1 WHERE message_id = ?",
-        [(message_id,) for message_id in message_ids],
-    )
-    conn.commit()
+                (
+                    summary,
+                    len(message_ids),
+                    datetime.now(timezone.utc).isoformat(),
+                    chat_id,
+                ),
+            )
+            cursor.executemany(
+                "UPDATE messages SET summarized = 1 "
+                "WHERE message_id = ? AND chat_id = ?",
+                [(message_id, chat_id) for message_id in message_ids],
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
     logger.info("Сохранен пересказ %d сообщений.", len(message_ids))
 
 
-def attach_reply_targets(conn: sqlite3.Connection, messages: list):
+def save_gemini_file_name(conn: sqlite3.Connection, file_id: str, gemini_name: str):
+    """
+    Запоминает, под каким именем файл Telegram лежит в Gemini.
+
+    Имя пишем во все сообщения с этим файлом: после перезапуска по нему можно забрать
+    уже выгруженный файл, а не выгружать его заново.
+
+    :param conn: соединение с базой данных
+    :type conn: sqlite3.Connection
+    :param file_id: идентификатор файла в Telegram
+    :type file_id: str
+    :param gemini_name: имя файла в Gemini вида "files/..."
+    :type gemini_name: str
+    """
+    with DB_LOCK:
+        conn.execute(
+            "UPDATE messages SET gemini_file_name = ? WHERE file_id = ?",
+            (gemini_name, file_id),
+        )
+
+
+# Колонки адресата ответа, которые нужны describe_reply_target.
+REPLY_TARGET_COLUMNS = (
+    "message_id, is_bot, username, content, forward_origin, media_type"
+)
+
+
+def attach_reply_targets(conn: sqlite3.Connection, chat_id: int, messages: list):
     """
     Подкладывает к каждой реплике-ответу сообщение, которому она отвечает.
 
-    Ищем по всей таблице, а не по переданному куску истории: адресат мог остаться далеко
-    позади и уже уйти в пересказ, но пометка о нем все равно нужна.
+    Ищем по всей истории чата, а не по переданному куску: адресат мог остаться далеко
+    позади и уже уйти в пересказ, но пометка о нем все равно нужна. Только в этом чате:
+    Telegram нумерует сообщения в каждом чате отдельно, и тот же message_id в другом
+    чате - чужое сообщение.
 
     :param conn: соединение с базой данных
     :type conn: sqlite3.Connection
+    :param chat_id: чат, которому принадлежат сообщения
+    :type chat_id: int
     :param messages: сообщения контекста; в отвечающие добавляется ключ "reply_target"
         со строкой адресата или None, если такого сообщения в базе нет
     :type messages: list
@@ -636,14 +1091,12 @@ def attach_reply_targets(conn: sqlite3.Connection, messages: list):
     cursor = conn.cursor()
     # В строку запроса подставляем только число "?" - сами идентификаторы идут параметрами.
     cursor.execute(
-        f"SELECT * FROM messages WHERE message_id IN ({','.join('?' * len(target_ids))})",
-        tuple(target_ids),
+        f"SELECT {REPLY_TARGET_COLUMNS} FROM messages "
+        f"WHERE chat_id = ? AND message_id IN ({','.join('?' * len(target_ids))})",
+        (chat_id, *target_ids),
     )
-    columns = [description[0] for description in cursor.description]
-    targets = {}
-    for row in cursor.fetchall():
-        target = dict(zip(columns, row))
-        targets[target["message_id"]] = target
+    # Адресатов только читаем, поэтому оставляем их строками sqlite3.Row, без копий в dict.
+    targets = {row["message_id"]: row for row in cursor.fetchall()}
 
     for msg in messages:
         reply_to_id = msg.get("reply_to_message_id")
@@ -651,39 +1104,124 @@ def attach_reply_targets(conn: sqlite3.Connection, messages: list):
             msg["reply_target"] = targets.get(reply_to_id)
 
 
-def get_context(conn: sqlite3.Connection) -> tuple[str | None, list]:
+# Колонки, которые нужны для сборки контекста. Остальные (user_id, media_type, timestamp и
+# служебные) в запрос к модели не идут, и тянуть их в словари незачем.
+CONTEXT_COLUMNS = (
+    "message_id, chat_id, username, content, mime_type, file_id, file_name, "
+    "gemini_file_name, reply_to_message_id, quote_text, forward_origin, is_bot"
+)
+
+
+def get_context(
+    conn: sqlite3.Connection, chat_id: int, limit: int = MAX_CONTEXT_MESSAGES
+) -> tuple[str | None, list]:
     """
-    Получает контекст для модели: пересказ старой части истории и сообщения после нее.
+    Получает контекст для модели: пересказ старой части истории чата и сообщения после нее.
 
-    Пока сжатия не было, пересказ пуст и возвращается вся история.
+    Пока сжатия не было, пересказ пуст и возвращается вся история чата (но не больше
+    limit последних сообщений).
 
     Args:
         conn (sqlite3.Connection): Соединение с базой данных.
+        chat_id (int): Идентификатор чата.
+        limit (int, optional): Сколько последних несжатых сообщений читать.
 
     Returns:
         tuple: (текст пересказа или None, список словарей с информацией о сообщениях;
         у реплик-ответов в ключе "reply_target" лежит сообщение, которому они отвечают).
     """
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT * FROM messages WHERE summarized = 0
-        ORDER BY timestamp ASC, message_id ASC
-    """)
-    columns = [description[0] for description in cursor.description]
-    messages = [dict(zip(columns, row)) for row in cursor.fetchall()]
-    attach_reply_targets(conn, messages)
-    return get_latest_summary(conn), messages
+    # Берем хвост истории по индексу от свежих к старым и разворачиваем уже в Python.
+    cursor.execute(
+        f"""
+        SELECT {CONTEXT_COLUMNS} FROM messages WHERE chat_id = ? AND summarized = 0
+        ORDER BY timestamp DESC, message_id DESC
+        LIMIT ?
+    """,
+        (chat_id, limit),
+    )
+    messages = [dict(row) for row in cursor.fetchall()]
+    messages.reverse()
+    attach_reply_targets(conn, chat_id, messages)
+    return get_latest_summary(conn, chat_id), messages
+
+
+def read_context(chat_id: int) -> tuple[str | None, list]:
+    """
+    То же, что get_context, но через соединение из пула. Рассчитана на запуск в потоке.
+
+    :param chat_id: чат, для которого собирается контекст
+    :type chat_id: int
+    :return: (последний пересказ или None, несжатые сообщения от старых к новым)
+    :rtype: tuple[str | None, list]
+    """
+    with borrow_read_connection() as conn:
+        return get_context(conn, chat_id)
 
 
 # --- БЛОК УТИЛИТ ДЛЯ МЕДИА ---
 
-uploaded_files = {}
+# Файлы, выгруженные в Gemini: file_id Telegram -> объект файла Gemini. Ключ - file_id, а
+# не путь: одна и та же картинка, пересланная несколько раз, выгружается один раз.
+# Порядок - от давно не нужных к свежим, лишнее сверх UPLOADED_FILES_LIMIT вытесняется.
+uploaded_files = OrderedDict()
+
 
+def remember_uploaded_file(file_id: str, remote_file):
+    """
+    Кладет выгруженный файл в uploaded_files, вытесняя самые давно не нужные.
 
+    :param file_id: идентификатор файла в Telegram
+    :type file_id: str
+    :param remote_file: объект файла Gemini
+    """
+    uploaded_files[file_id] = remote_file
+    uploaded_files.move_to_end(file_id)
+    while len(uploaded_files) > UPLOADED_FILES_LIMIT:
+        uploaded_files.popitem(last=False)
+
+
+def get_file_time_left(remote_file) -> timedelta | None:
+    """
+    Считает, сколько файлу осталось храниться в Gemini (около 48 часов после выгрузки).
+
+    :param remote_file: объект файла Gemini
+    :return: оставшееся время (отрицательное, если срок прошел) или None, если API
+        срока не сообщил
+    :rtype: timedelta | None
+    """
+    expires = getattr(remote_file, "expiration_time", None)
+    return expires - datetime.now(timezone.utc) if expires is not None else None
+
+
+# Все, что не должно попасть в имя файла на диске. Имена тут только ASCII (остальные
+# заменяются на file_id), так что это те же буквы, цифры и " ._-", что и раньше.
+UNSAFE_NAME_CHARS = re.compile(r"[^A-Za-z0-9 ._-]")
+
+# Подстрока MIME-типа -> расширение файла. Проверяются по порядку, первое совпадение
+# выигрывает.
+MIME_EXTENSIONS = {
+    "jpeg": "jpg",
+    "png": "png",
+    "gif": "gif",
+    "webp": "webp",
+    "ogg": "ogg",
+    "mp4": "mp4",
+    "mpeg": "mp3",
+    "pdf": "pdf",
+    "webm": "webm",
+}
+
+
+# Различных MIME-типов в чате единицы, а спрашивают про них на каждое медиа в контексте.
+@functools.lru_cache(maxsize=64)
 def get_extension_from_mime(mime: str | None) -> str:
     """
     Определяет расширение файла по его MIME-типу.
 
+    Совпадение ищется по подстроке, а не по подтипу целиком: по расширению строится имя
+    уже скачанного файла, и смена правила потеряла бы файлы, сохраненные раньше.
+
     Args:
         mime (str | None): MIME-тип файла.
 
@@ -692,19 +1230,9 @@ def get_extension_from_mime(mime: str | None) -> str:
     """
     if not mime:
         return "bin"
-    mime_map = {
-        "jpeg": "jpg",
-        "png": "png",
-        "gif": "gif",
-        "webp": "webp",
-        "ogg": "ogg",
-        "mp4": "mp4",
-        "mpeg": "mp3",
-        "pdf": "pdf",
-        "webm": "webm",
-    }
-    for key, value in mime_map.items():
-        if key in mime.lower():
+    lowered = mime.lower()
+    for key, value in MIME_EXTENSIONS.items():
+        if key in lowered:
             return value
     return mime.split("/")[-1]
 
@@ -722,87 +1250,280 @@ def get_media_path(
 
     Returns:
         str | None: Путь к файлу или None, если файл не может быть сохранен.
+        Путь нормализован: загрузчик и сборка контекста получают одну и ту же строку.
     """
     if original_name and original_name.isascii():
-        safe_name = "".join(
-            c for c in original_name if c.isalnum() or c in (" ", ".", "_", "-")
-        ).strip()
-        return os.path.join(MEDIA_DIR, safe_name)
+        safe_name = UNSAFE_NAME_CHARS.sub("", original_name).strip()
+        return os.path.normpath(os.path.join(MEDIA_DIR, safe_name))
     if file_id:
         ext = get_extension_from_mime(mime_type)
-        return os.path.join(MEDIA_DIR, f"{file_id}.{ext}")
+        return os.path.normpath(os.path.join(MEDIA_DIR, f"{file_id}.{ext}"))
     return None
 
 
-async def download_media_file(application: Application, file_id: str, file_path: str):
+# Файлы, которые уже лежат в MEDIA_DIR: имя -> размер в байтах. Заполняется при старте и
+# пополняется после каждой загрузки: так при сборке контекста не нужно дергать диск на
+# каждое сообщение с вложением - ни проверять, есть ли файл, ни узнавать его размер.
+# Кроме бота, в папку никто не пишет.
+present_files = {}
+# file_id, чьи файлы уже скачаны. По нему повторно присланный стикер или картинка
+# отсеиваются сразу, без сборки пути. Заполняется при старте из БД и после загрузок.
+downloaded_file_ids = set()
+# file_id, которые качать не стали или не смогли: file_id -> время, с которого можно
+# попробовать снова, или None, если не стоит вовсе (файл больше MAX_DOWNLOAD_BYTES).
+refused_downloads = {}
+
+
+def refuse_download(file_id: str, retry: bool = True):
     """
-    Загружает медиа-файл из Telegram.
+    Запоминает, что файл сейчас не скачать.
+
+    :param file_id: идентификатор файла в Telegram
+    :type file_id: str
+    :param retry: попробовать позже (сбой) или больше не пробовать (файл слишком большой)
+    :type retry: bool
+    """
+    refused_downloads[file_id] = (
+        datetime.now(timezone.utc) + DOWNLOAD_RETRY_DELAY if retry else None
+    )
+
+
+def is_download_refused(file_id: str) -> bool:
+    """
+    Проверяет, не отказались ли уже качать файл.
+
+    :param file_id: идентификатор файла в Telegram
+    :type file_id: str
+    :return: True, если файл сейчас качать не надо
+    :rtype: bool
+    """
+    if file_id not in refused_downloads:
+        return False
+    retry_at = refused_downloads[file_id]
+    if retry_at is None or retry_at > datetime.now(timezone.utc):
+        return True
+    del refused_downloads[file_id]
+    return False
+
+
+def load_downloaded_file_ids(cursor: sqlite3.Cursor):
+    """
+    Отмечает в downloaded_file_ids файлы из БД, которые уже лежат на диске.
+
+    :param cursor: курсор базы данных
+    :type cursor: sqlite3.Cursor
+    """
+    cursor.execute(
+        "SELECT DISTINCT file_id, mime_type, file_name FROM messages "
+        "WHERE file_id IS NOT NULL"
+    )
+    for file_id, mime_type, file_name in cursor.fetchall():
+        file_path = get_media_path(file_id, mime_type, file_name)
+        if file_path and os.path.basename(file_path) in present_files:
+            downloaded_file_ids.add(file_id)
+
+
+# Загрузки из Telegram, которые идут прямо сейчас: путь к файлу -> задача загрузки.
+# Медиа качается в фоне, и ответ может понадобиться раньше, чем файл доедет: тогда
+# ответ ждет ту же загрузку, а не запускает вторую в тот же файл.
+active_downloads = {}
+
+
+def write_media_file(file_path: str, data: bytearray):
+    """
+    Записывает скачанный файл на диск.
+
+    Пишем во временный файл и переименовываем: оборванная запись не оставит в папке
+    битый файл, который при следующем запуске сочли бы скачанным.
+
+    :param file_path: путь для сохранения файла
+    :type file_path: str
+    :param data: содержимое файла
+    :type data: bytearray
+    """
+    temp_path = f"{file_path}.part"
+    with open(temp_path, "wb") as file:
+        file.write(data)
+    os.replace(temp_path, file_path)
+
+
+async def fetch_media_file(application: Application, file_id: str, file_path: str):
+    """
+    Скачивает медиа-файл из Telegram на диск.
 
     Args:
         application (Application): Объект приложения Telegram.
         file_id (str): Идентификатор файла в Telegram.
         file_path (str): Путь для сохранения файла.
     """
-    if os.path.exists(file_path):
-        return
     try:
         logger.info("Загрузка файла %s в %s...", file_id, file_path)  # lazy logging
         tg_file = await application.bot.get_file(file_id)
-        await tg_file.download_to_drive(file_path)
+        # Размер из сообщения знают не всегда (например, для файлов из старого контекста),
+        # а у выданного файла он есть: проверяем до того, как качать его в память.
+        if tg_file.file_size and tg_file.file_size > MAX_DOWNLOAD_BYTES:
+            logger.warning(
+                "Файл %s слишком большой (%d байт), не загружаем.",
+                file_id,
+                tg_file.file_size,
+            )
+            refuse_download(file_id, retry=False)
+            return
+        # download_to_drive пишет файл прямо в event loop. Качаем в память, а на диск
+        # пишем в потоке, чтобы большой файл не стопорил остальные обновления.
+        data = await tg_file.download_as_bytearray()
+        await asyncio.to_thread(write_media_file, file_path, data)
+        present_files[os.path.basename(file_path)] = len(data)
+        downloaded_file_ids.add(file_id)
         logger.info("Файл успешно загружен: %s", file_path)  # lazy logging
-    except (OSError, IOError) as e:
+    except (OSError, TelegramError) as e:
+        # TelegramError - в том числе отказ отдавать файл больше 20 МБ: без файла
+        # сообщение в контексте все равно останется.
         logger.error("Ошибка загрузки файла %s: %s", file_id, e)  # lazy logging
+        refuse_download(file_id)
+
+
+async def download_media_file(application: Application, file_id: str, file_path: str):
+    """
+    Загружает медиа-файл из Telegram, если его еще нет на диске.
+
+    Args:
+        application (Application): Объект приложения Telegram.
+        file_id (str): Идентификатор файла в Telegram.
+        file_path (str): Путь для сохранения файла.
+    """
+    if os.path.basename(file_path) in present_files:
+        return
+    download = active_downloads.get(file_path)
+    if download is None:
+        download = asyncio.create_task(
+            fetch_media_file(application, file_id, file_path)
+        )
+        active_downloads[file_path] = download
+        download.add_done_callback(lambda _: active_downloads.pop(file_path, None))
+    # Отмена одного ждущего не должна обрывать загрузку, которую ждут и другие.
+    await asyncio.shield(download)
+
+
+async def download_context_media(application: Application, messages: list):
+    """
+    Докачивает медиа сообщений контекста, которого нет на диске, все файлы разом.
+
+    Обычно все уже скачано в фоне, но загрузка могла не успеть или когда-то сорваться.
+
+    Args:
+        application (Application): Объект приложения Telegram.
+        messages (list): Сообщения контекста.
+    """
+    paths = {}
+    for msg in messages:
+        file_id = msg.get("file_id")
+        if (
+            file_id
+            and file_id not in downloaded_file_ids
+            and not is_download_refused(file_id)
+        ):
+            file_path = get_media_path(
+                file_id, msg.get("mime_type"), msg.get("file_name")
+            )
+            if file_path:
+                paths[file_path] = file_id
+    await asyncio.gather(
+        *(
+            download_media_file(application, file_id, file_path)
+            for file_path, file_id in paths.items()
+        )
+    )
 
 
 # --- БЛОК ИНТЕГРАЦИИ С GEMINI ---
 
 
-def check_file_validity(client: genai.Client, media_path: str):
+async def check_file_validity(
+    client: genai.Client, file_id: str, stored_name: str | None = None
+):
     """
     Проверяет валидность файла
 
+    Живой файл кладется в uploaded_files, мертвый (истек срок хранения, сломался при
+    обработке) убирается оттуда. Так же после перезапуска поднимается файл, выгруженный
+    в прошлый раз: в памяти его еще нет, но имя сохранено в БД. Файл из памяти, которому
+    жить еще дольше FILE_EXPIRY_MARGIN, считается живым без запроса к API.
+
     :param client: клиент ИИ
     :type client: genai.Client
-    :param media_path: путь к файлу
-    :type media_path: str
-    """
-    if media_path in uploaded_files:
-        try:
-            remote_file = client.files.get(name=uploaded_files[media_path].name)
-            if remote_file.state.name != "ACTIVE":
-                logger.info(
-                    "Файл %s в состоянии %s, требуется перевыгрузка",
-                    media_path,
-                    remote_file.state.name,
-                )
-                del uploaded_files[media_path]
-        except Exception as e:  # pylint: disable=broad-exception-caught
-            logger.warning(
-                "Не удалось проверить статус файла %s, перевыгружаем: %s",
-                media_path,
-                e,
-            )
-            del uploaded_files[media_path]
+    :param file_id: идентификатор файла в Telegram
+    :type file_id: str
+    :param stored_name: имя файла в Gemini из БД или None, если его там нет
+    :type stored_name: str | None
+    """
+    cached = uploaded_files.get(file_id)
+    time_left = get_file_time_left(cached) if cached is not None else None
+    if time_left is not None:
+        if time_left <= timedelta(0):
+            # Спрашивать API незачем: файл уже удален, и имя из БД указывает на него же.
+            uploaded_files.pop(file_id, None)
+            return
+        if time_left > FILE_EXPIRY_MARGIN:
+            # Файл из истории нужен почти в каждом ответе, а жив он наверняка.
+            uploaded_files.move_to_end(file_id)
+            return
+    name = cached.name if cached else stored_name
+    if not name:
+        return
+    try:
+        remote_file = await asyncio.to_thread(client.files.get, name=name)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logger.warning(
+            "Не удалось проверить статус файла %s, перевыгружаем: %s",
+            file_id,
+            e,
+        )
+        uploaded_files.pop(file_id, None)
+        return
+
+    if remote_file.state.name == "ACTIVE":
+        remember_uploaded_file(file_id, remote_file)
+    else:
+        logger.info(
+            "Файл %s в состоянии %s, требуется перевыгрузка",
+            file_id,
+            remote_file.state.name,
+        )
+        uploaded_files.pop(file_id, None)
 
 
-def upload_file(client: genai.Client, media_path):
+async def upload_file(
+    client: genai.Client, conn: sqlite3.Connection, file_id: str, media_path: str
+):
     """
     Загружает файл
 
     :param client: клиент ИИ
     :type client: genai.Client
+    :param conn: соединение с базой данных - в нее пишется имя выгруженного файла
+    :type conn: sqlite3.Connection
+    :param file_id: идентификатор файла в Telegram
+    :type file_id: str
     :param media_path: путь к файлу
     :type media_path: str
     """
-    uploaded_file = client.files.upload(file=media_path)
+    # Вызовы SDK синхронные, а выгрузка может идти долго: уводим их в поток.
+    uploaded_file = await asyncio.to_thread(client.files.upload, file=media_path)
 
     # Цикл ожидания перехода в рабочее состояние
     while uploaded_file.state.name == "PROCESSING":
-        time.sleep(2)
-        uploaded_file = client.files.get(name=uploaded_file.name)
+        await asyncio.sleep(2)
+        uploaded_file = await asyncio.to_thread(
+            client.files.get, name=uploaded_file.name
+        )
 
     if uploaded_file.state.name == "ACTIVE":
-        uploaded_files[media_path] = uploaded_file
+        remember_uploaded_file(file_id, uploaded_file)
+        # Запись с коммитом блокирует, поэтому, как и остальная работа с БД, идет в потоке.
+        await asyncio.to_thread(
+            save_gemini_file_name, conn, file_id, uploaded_file.name
+        )
     else:
         logger.error(
             "Файл %s после загрузки перешел в состояние %s",
@@ -904,7 +1625,7 @@ def extract_response_text(response) -> tuple[str | None, str, bool]:
 
 async def generate_with_retries(
     client: genai.Client, contents: list, config=None
-) -> str:
+) -> tuple[str, int | None]:
     """
     Запрашивает ответ у Gemini, повторяя попытки при сбоях и пустых ответах.
 
@@ -918,8 +1639,9 @@ async def generate_with_retries(
     :type contents: list
     :param config: настройки генерации (инструменты и прочее) или None
     :type config: genai.types.GenerateContentConfig | None
-    :return: текст ответа модели
-    :rtype: str
+    :return: текст ответа модели и размер запроса в токенах по usage_metadata (None,
+        если API его не прислал)
+    :rtype: tuple[str, int | None]
     :raises GeminiRetryError: если попытки исчерпаны
     """
     last_reason = "причина неизвестна"
@@ -952,7 +1674,8 @@ async def generate_with_retries(
                     logger.info(
                         "Ответ получен с попытки %d из %d.", attempt, MAX_RETRIES
                     )
-                return text
+                usage = getattr(response, "usage_metadata", None)
+                return text, getattr(usage, "prompt_token_count", None)
             if not can_retry:
                 logger.error("Повтор бесполезен: %s", reason)
                 raise GeminiRetryError(
@@ -975,82 +1698,185 @@ async def generate_with_retries(
     )
 
 
-def build_message_parts(client: genai.Client, msg: dict) -> list:
+# Системный промпт от запроса к запросу не меняется - собираем его реплику один раз.
+SYSTEM_CONTENT = genai.types.ContentDict(
+    role="user", parts=[genai.types.PartDict(text=SYSTEM_PROMPT)]
+)
+
+# Готовые текстовые части реплик:
+# (chat_id, message_id) -> (reply_to_message_id, content, Part).
+# Контекст каждого запроса - почти те же сообщения, что и в прошлый раз, и пересобирать
+# их тексты заново незачем. Ответ на сообщение хранится вместе с адресатом: правка
+# адресата меняет и пометку в ответе. Часть годится, только пока текст тот же, из
+# которого ее собрали: подмененный для одного запроса текст (просьба расшифровать
+# голосовое) не должен попасть в следующие. Сжатые в пересказ сообщения отсюда уходят.
+message_parts = {}
+
+
+async def prepare_media_part(
+    client: genai.Client, conn: sqlite3.Connection, msg: dict
+) -> genai.types.Part | None:
     """
-    Превращает одно сообщение из БД в части запроса к модели.
+    Готовит вложение сообщения к запросу: проверяет выгруженный в Gemini файл и при
+    нужде выгружает его заново.
 
     :param client: клиент ИИ
     :type client: genai.Client
+    :param conn: соединение с базой данных
+    :type conn: sqlite3.Connection
+    :param msg: строка таблицы messages в виде словаря (с file_id и mime_type)
+    :type msg: dict
+    :return: часть с файлом, текстовая пометка о пропущенном файле или None, если
+        файла нет на диске
+    :rtype: genai.types.Part | None
+    """
+    file_id = msg["file_id"]
+    media_path = get_media_path(file_id, msg["mime_type"], msg.get("file_name"))
+    file_size = present_files.get(os.path.basename(media_path)) if media_path else None
+    if file_size is None:
+        return None
+
+    try:
+        if file_size >= MAX_UPLOAD_BYTES:
+            logger.warning(
+                "Файл %s слишком большой (%.2f МБ), пропускаем",
+                media_path,
+                file_size / 1024 / 1024,
+            )
+            return genai.types.Part(
+                text="[Файл слишком большой для обработки - пропущено]"
+            )
+
+        # Проверяем, есть ли файл в кэше и валиден ли он
+        await check_file_validity(client, file_id, msg.get("gemini_file_name"))
+
+        # Загрузка, если файла нет в кэше (или он был удален выше)
+        if file_id not in uploaded_files:
+            await upload_file(client, conn, file_id, media_path)
+
+        remote_file = uploaded_files.get(file_id)
+        if remote_file is None:
+            return genai.types.Part(
+                text="[Ошибка обработки файла - не удалось активировать]"
+            )
+        return genai.types.Part(
+            file_data=genai.types.FileData(
+                file_uri=remote_file.uri, mime_type=remote_file.mime_type
+            )
+        )
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logger.error(
+            "Ошибка при работе с медиафайлом %s: %s",
+            media_path,
+            e,
+        )
+        return None
+
+
+async def prepare_media_parts(
+    client: genai.Client, conn: sqlite3.Connection, context_messages: list
+) -> dict:
+    """
+    Готовит вложения всех сообщений контекста разом.
+
+    Проверка и выгрузка - сетевые вызовы, и по одному они выстраивались бы в очередь.
+    Поэтому идут параллельно, но не больше UPLOAD_CONCURRENCY за раз. Файл, присланный
+    несколько раз, готовится один раз.
+
+    :param client: клиент ИИ
+    :type client: genai.Client
+    :param conn: соединение с базой данных
+    :type conn: sqlite3.Connection
+    :param context_messages: список сообщений контекста
+    :type context_messages: list
+    :return: file_id -> результат prepare_media_part
+    :rtype: dict
+    """
+    media_messages = {}
+    for msg in context_messages:
+        if msg.get("file_id") and msg.get("mime_type"):
+            media_messages.setdefault(msg["file_id"], msg)
+
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async def prepare(msg: dict) -> genai.types.Part | None:
+        async with semaphore:
+            return await prepare_media_part(client, conn, msg)
+
+    results = await asyncio.gather(*(prepare(msg) for msg in media_messages.values()))
+    return dict(zip(media_messages, results))
+
+
+def forget_message_parts(chat_id: int, message_id: int, edited: bool = False):
+    """
+    Выкидывает из message_parts готовую часть сообщения.
+
+    :param chat_id: чат сообщения
+    :type chat_id: int
+    :param message_id: идентификатор сообщения
+    :type message_id: int
+    :param edited: сообщение отредактировали - тогда устарели и пометки в ответах на него
+    :type edited: bool
+    """
+    message_parts.pop((chat_id, message_id), None)
+    if edited:
+        stale = [
+            key
+            for key, (reply_to_id, _, _) in message_parts.items()
+            if key[0] == chat_id and reply_to_id == message_id
+        ]
+        for key in stale:
+            del message_parts[key]
+
+
+def build_text_part(msg: dict) -> genai.types.Part:
+    """
+    Собирает текстовую часть сообщения, беря готовую из message_parts, если она есть.
+
     :param msg: строка таблицы messages в виде словаря
     :type msg: dict
-    :return: список частей (текст плюс медиа, если оно есть)
-    :rtype: list
+    :return: текст реплики с автором и служебной пометкой
+    :rtype: genai.types.Part
     """
-    parts = []
+    key = (msg.get("chat_id"), msg.get("message_id"))
     content = msg.get("content")
+    cached = message_parts.get(key)
+    if cached is not None and cached[1] == content:
+        return cached[2]
+
     if msg.get("is_bot"):
         # Свои реплики модель получает без служебных пометок, чтобы не копировать их
         # в новые ответы: роль "model" и так говорит, чьи это слова.
-        parts.append(genai.types.Part(text=content or "[Пустой ответ]"))
+        part = genai.types.Part(text=content or "[Пустой ответ]")
     else:
         author = msg.get("username") or "unknown"
         text = f"[{author}]: {content}" if content else f"[{author}]"
         note = build_service_note(msg)
-        parts.append(genai.types.Part(text=f"{note}\n{text}" if note else text))
+        part = genai.types.Part(text=f"{note}\n{text}" if note else text)
+    message_parts[key] = (msg.get("reply_to_message_id"), content, part)
+    return part
 
-    if msg.get("file_id") and msg.get("mime_type"):
-        raw_path = get_media_path(
-            msg["file_id"], msg["mime_type"], msg.get("file_name")
-        )
-        media_path = os.path.abspath(raw_path) if raw_path else None
-        if media_path and os.path.exists(media_path):
-            try:
-                file_size = os.path.getsize(media_path)
-                if file_size < 20 * 1024 * 1024:
-                    # Проверяем, есть ли файл в кэше и валиден ли он
-                    check_file_validity(client, media_path)
-
-                    # Загрузка, если файла нет в кэше (или он был удален выше)
-                    if media_path not in uploaded_files:
-                        upload_file(client, media_path)
-
-                    # Если файл успешно загружен и активен
-                    if media_path in uploaded_files:
-                        parts.append(
-                            genai.types.Part(
-                                file_data=genai.types.FileData(
-                                    file_uri=uploaded_files[media_path].uri,
-                                    mime_type=uploaded_files[media_path].mime_type,
-                                )
-                            )
-                        )
-                    else:
-                        parts.append(
-                            genai.types.Part(
-                                text="[Ошибка обработки файла - не удалось активировать]"
-                            )
-                        )
-                else:
-                    logger.warning(
-                        "Файл %s слишком большой (%.2f МБ), пропускаем",
-                        media_path,
-                        file_size / 1024 / 1024,
-                    )
-                    parts.append(
-                        genai.types.Part(
-                            text="[Файл слишком большой для обработки - пропущено]"
-                        )
-                    )
-            except Exception as e:  # pylint: disable=broad-exception-caught
-                logger.error(
-                    "Ошибка при работе с медиафайлом %s: %s",
-                    media_path,
-                    e,
-                )
+
+def build_message_parts(msg: dict, media_part: genai.types.Part | None) -> list:
+    """
+    Превращает одно сообщение из БД в части запроса к модели.
+
+    :param msg: строка таблицы messages в виде словаря
+    :type msg: dict
+    :param media_part: готовое вложение от prepare_media_part или None
+    :type media_part: genai.types.Part | None
+    :return: список частей (текст плюс медиа, если оно есть)
+    :rtype: list
+    """
+    parts = [build_text_part(msg)]
+    if media_part is not None:
+        parts.append(media_part)
     return parts
 
 
-def build_history(client: genai.Client, context_messages: list) -> list:
+async def build_history(
+    client: genai.Client, conn: sqlite3.Connection, context_messages: list
+) -> list:
     """
     Готовит историю переписки в виде реплик для модели.
 
@@ -1059,14 +1885,17 @@ def build_history(client: genai.Client, context_messages: list) -> list:
 
     :param client: клиент ИИ
     :type client: genai.Client
+    :param conn: соединение с базой данных
+    :type conn: sqlite3.Connection
     :param context_messages: список сообщений контекста
     :type context_messages: list
     :return: список словарей вида {"role", "parts", "source"}
     :rtype: list
     """
+    media_parts = await prepare_media_parts(client, conn, context_messages)
     history = []
     for msg in context_messages:
-        parts = build_message_parts(client, msg)
+        parts = build_message_parts(msg, media_parts.get(msg.get("file_id")))
         if parts:
             role = "model" if msg.get("is_bot") else "user"
             history.append({"role": role, "parts": parts, "source": msg})
@@ -1087,11 +1916,7 @@ def build_contents(history: list, summary: str | None) -> list:
     :return: содержимое запроса к модели
     :rtype: list
     """
-    contents = [
-        genai.types.ContentDict(
-            role="user", parts=[genai.types.PartDict(text=SYSTEM_PROMPT)]
-        )
-    ]
+    contents = [SYSTEM_CONTENT]
 
     # Сжатая часть истории идет перед дословными сообщениями, в хронологическом порядке.
     if summary:
@@ -1132,6 +1957,60 @@ def estimate_entry_tokens(entry: dict) -> float:
     return total
 
 
+# Точный размер последнего запроса в каждом чате - его бесплатно сообщает сам ответ:
+# chat_id -> (message_id первой и последней реплики, пересказ, токенов в запросе).
+# Следующий запрос - тот же, плюс несколько новых реплик, и их хватает прикинуть на глаз.
+context_sizes = {}
+
+
+def remember_context_size(history: list, summary: str | None, prompt_tokens: int):
+    """
+    Запоминает точный размер только что отправленного запроса.
+
+    Ключ - история и пересказ до сжатия: если сжатие было, в БД уже лежит новый
+    пересказ, запись со старым не совпадет и не будет использована.
+
+    :param history: история переписки от build_history (непустая)
+    :type history: list
+    :param summary: пересказ, с которым собиралась история
+    :type summary: str | None
+    :param prompt_tokens: размер запроса по usage_metadata
+    :type prompt_tokens: int
+    """
+    context_sizes[history[0]["source"]["chat_id"]] = (
+        history[0]["source"]["message_id"],
+        history[-1]["source"]["message_id"],
+        summary,
+        prompt_tokens,
+    )
+
+
+def estimate_from_last_request(history: list, summary: str | None) -> float | None:
+    """
+    Оценивает размер контекста от точного размера прошлого запроса в этом чате.
+
+    :param history: история переписки от build_history (непустая)
+    :type history: list
+    :param summary: пересказ сжатой части истории или None
+    :type summary: str | None
+    :return: примерное число токенов или None, если прошлый запрос был про другую
+        историю (ее начало сдвинулось, сменился пересказ, запроса еще не было)
+    :rtype: float | None
+    """
+    known = context_sizes.get(history[0]["source"]["chat_id"])
+    if known is None:
+        return None
+    first_id, last_id, known_summary, tokens = known
+    if history[0]["source"]["message_id"] != first_id or known_summary != summary:
+        return None
+    for index in range(len(history) - 1, -1, -1):
+        if history[index]["source"]["message_id"] == last_id:
+            return tokens + sum(
+                estimate_entry_tokens(entry) for entry in history[index + 1 :]
+            )
+    return None
+
+
 def estimate_context_tokens(history: list, summary: str | None) -> float:
     """
     Грубо оценивает размер всего контекста, чтобы не дергать API на каждое сообщение.
@@ -1248,7 +2127,8 @@ async def summarize_history(
     )
 
     logger.info("Сжимаем %d самых старых сообщений в пересказ...", len(entries))
-    return (await generate_with_retries(client, contents)).strip()
+    text, _ = await generate_with_retries(client, contents)
+    return text.strip()
 
 
 async def compress_context(
@@ -1285,9 +2165,12 @@ async def compress_context(
     # Дешевая прикидка на входе: обычный чат до лимита не дотягивает, и тратить на него
     # лишний запрос к API незачем. Дальше по кругу идем уже только с точным подсчетом -
     # ошибись прикидка, и сжатие остановилось бы, не дойдя до лимита.
-    if estimate_context_tokens(history, summary) < (
-        MAX_CONTEXT_TOKENS * TOKEN_CHECK_RATIO
-    ):
+    # Если в этом чате уже был запрос, от его точного размера прикидка выходит точнее:
+    # грубая оценка всей истории завышает кириллицу и медиа и зря зовет count_tokens.
+    estimate = estimate_from_last_request(history, summary)
+    if estimate is None:
+        estimate = estimate_context_tokens(history, summary)
+    if estimate < MAX_CONTEXT_TOKENS * TOKEN_CHECK_RATIO:
         return contents
 
     for _ in range(MAX_COMPRESSION_ROUNDS):
@@ -1318,9 +2201,13 @@ async def compress_context(
             logger.error("Не удалось сжать контекст, отправляем как есть: %s", e)
             return contents
 
-        save_summary(
-            conn, summary, [entry["source"]["message_id"] for entry in history[:cut]]
-        )
+        # Вся история запроса - из одного чата, берем его у любой реплики.
+        chat_id = history[0]["source"]["chat_id"]
+        message_ids = [entry["source"]["message_id"] for entry in history[:cut]]
+        await asyncio.to_thread(save_summary, conn, chat_id, summary, message_ids)
+        # В контекст эти сообщения больше не попадут.
+        for message_id in message_ids:
+            forget_message_parts(chat_id, message_id)
         history = history[cut:]
         contents = build_contents(history, summary)
 
@@ -1341,7 +2228,8 @@ async def generate_gemini_response(
 
     Args:
         client (genai.GenerativeModel): Клиент Google Gemini AI.
-        conn (sqlite3.Connection): Соединение с БД - нужно, чтобы сохранить пересказ.
+        conn (sqlite3.Connection): Соединение с БД - нужно, чтобы сохранить пересказ и
+        имена выгруженных файлов.
         context_messages (list): Список сообщений контекста.
         summary (str | None): Пересказ сжатой ранее части истории.
 
@@ -1349,7 +2237,7 @@ async def generate_gemini_response(
         str: Сгенерированный ответ.
     """
     logger.info("Подготовка %d сообщений контекста для Gemini.", len(context_messages))
-    history = build_history(client, context_messages)
+    history = await build_history(client, conn, context_messages)
 
     if not history:
         logger.warning("Контекст для Gemini пуст. Отмена запроса.")
@@ -1360,13 +2248,29 @@ async def generate_gemini_response(
     logger.info("Отправка запроса в Gemini...")
 
     # Генерируем ответ с новым API, повторяя попытки при сбоях
-    response_text = await generate_with_retries(client, contents, REPLY_CONFIG)
+    response_text, prompt_tokens = await generate_with_retries(
+        client, contents, REPLY_CONFIG
+    )
+    if prompt_tokens is not None:
+        remember_context_size(history, summary, prompt_tokens)
     return strip_service_prefixes(response_text)
 
 
 # --- ГЛАВНЫЙ ОБРАЗОВАТЕЛЬ TELEGRAM ---
 
 
+def starts_with_trigger(text: str | None) -> bool:
+    """
+    Проверяет, начинается ли текст с триггерного слова (без учета регистра).
+
+    :param text: текст или подпись сообщения
+    :type text: str | None
+    :return: True, если сообщение адресовано боту
+    :rtype: bool
+    """
+    return bool(text) and text[:TRIGGER_LENGTH].lower() == TRIGGER_PREFIX
+
+
 async def send_placeholder(message: Message) -> Message | None:
     """
     Отправляет сообщение-заглушку о начале генерации.
@@ -1417,7 +2321,7 @@ async def replace_placeholder(
 
 
 async def deliver_response(
-    db_conn: sqlite3.Connection,
+    write_queue: asyncio.Queue,
     message: Message,
     placeholder: Message | None,
     response_text: str,
@@ -1428,8 +2332,8 @@ async def deliver_response(
 
     Первый кусок заменяет заглушку, остальные уходят отдельными ответами.
 
-    :param db_conn: соединение с базой данных
-    :type db_conn: sqlite3.Connection
+    :param write_queue: очередь на запись в БД
+    :type write_queue: asyncio.Queue
     :param message: сообщение пользователя, на которое отвечаем
     :type message: Message
     :param placeholder: сообщение-заглушка или None, если ее не удалось отправить
@@ -1452,14 +2356,14 @@ async def deliver_response(
             bot_reply = await message.reply_text(chunk, parse_mode="HTML")
 
         if len(message_chunks) > 4:
-            time.sleep(10)
+            await asyncio.sleep(10)
 
         # Ответ модели сохраняем как есть, ошибку - одной короткой пометкой и один раз.
         if not err:
-            save_message_to_db(db_conn, bot_reply, is_bot=True)
+            await save_message_to_db(write_queue, bot_reply, is_bot=True)
         elif index == 0:
-            save_message_to_db(
-                db_conn, bot_reply, is_bot=True, content_override=ERROR_CONTEXT_NOTE
+            await save_message_to_db(
+                write_queue, bot_reply, is_bot=True, content_override=ERROR_CONTEXT_NOTE
             )
 
 
@@ -1474,30 +2378,54 @@ async def handle_message(  # pylint: disable=too-many-locals
         context (ContextTypes.DEFAULT_TYPE): Контекст обработчика.
     """
     message = update.effective_message
-    if not message or (
-        message.chat.type not in ("group", "supergroup")
-        and not message.chat.type == "private"
-    ):
+    if not message or message.chat.type not in ALLOWED_CHAT_TYPES:
         return
 
     err = False
 
     db_conn = context.bot_data["db_conn"]
-    triggered_by_text = (
-        message.text and message.text.lower().startswith(TRIGGER_WORD.lower())
-    ) or (message.caption and message.caption.lower().startswith(TRIGGER_WORD.lower()))
+    write_queue = context.bot_data["write_queue"]
+    triggered_by_text = starts_with_trigger(message.text) or starts_with_trigger(
+        message.caption
+    )
+    is_voice = bool(message.voice)
 
-    file_id, mime_type, file_name = save_message_to_db(db_conn, message, is_bot=False)
-    if file_id:
+    needs_reply = triggered_by_text or is_voice
+
+    file_id, mime_type, file_name, file_size, written = await save_message_to_db(
+        write_queue, message, is_bot=False
+    )
+    if file_size and file_size > MAX_DOWNLOAD_BYTES:
+        # Telegram такой файл не отдаст: не тратим на него ни задачу, ни запрос.
+        logger.warning(
+            "Файл %s слишком большой (%d байт), не загружаем.", file_id, file_size
+        )
+        refuse_download(file_id, retry=False)
+    elif (
+        file_id
+        and file_id not in downloaded_file_ids
+        and not is_download_refused(file_id)
+    ):
         file_path = get_media_path(file_id, mime_type, file_name)
         if file_path:
-            await download_media_file(context.application, file_id, file_path)
+            # Обработчик не ждет загрузку: файл понадобится только к следующему ответу.
+            # Если отвечаем на это сообщение, загрузка идет, пока ждем запись в БД и
+            # читаем контекст, а download_context_media потом просто дождется ее.
+            context.application.create_task(
+                download_media_file(context.application, file_id, file_path)
+            )
 
-    if triggered_by_text or bool(message.voice):
-        summary, context_messages = get_context(db_conn)
+    if needs_reply:
+        # Сообщения пишет фоновая задача: ждем, пока в БД ляжет это сообщение. Чужие
+        # записи, в том числе из других чатов, не ждем. Если записать не вышло, ошибку
+        # уже залогировал run_db_writer, а ответ все равно строим по тому, что есть в БД.
+        await written
+        summary, context_messages = await asyncio.to_thread(
+            read_context, message.chat_id
+        )
         gemini_client = context.bot_data["gemini_client"]
 
-        if bool(message.voice) and not triggered_by_text:
+        if is_voice and not triggered_by_text:
             # Расшифровке чужая история не нужна - ни сообщения, ни пересказ.
             context_messages = context_messages[-1:]
             summary = None
@@ -1505,14 +2433,18 @@ async def handle_message(  # pylint: disable=too-many-locals
                 context_messages
                 and context_messages[-1].get("message_id") == message.message_id
             ):
-                current_content = context_messages[-1].get("content", "")
-                context_messages[-1][
-                    "content"
-                ] = f"Напиши расшифровку голосового сообщения. {current_content}"
+                # Просьба о расшифровке нужна только этому запросу: меняем копию строки.
+                voice_message = dict(context_messages[-1])
+                current_content = voice_message.get("content", "")
+                voice_message["content"] = (
+                    f"Напиши расшифровку голосового сообщения. {current_content}"
+                )
+                context_messages = [voice_message]
 
         placeholder = await send_placeholder(message)
 
         try:
+            await download_context_media(context.application, context_messages)
             response_text = await generate_gemini_response(
                 gemini_client,
                 db_conn,
@@ -1525,12 +2457,41 @@ async def handle_message(  # pylint: disable=too-many-locals
             response_text = f"Произошла ошибка при обращении к нейросети: {e}"
             err = True
 
-        await deliver_response(db_conn, message, placeholder, response_text, err)
+        await deliver_response(write_queue, message, placeholder, response_text, err)
 
 
 # --- ТОЧКА ВХОДА ---
 
 
+async def start_background_tasks(application: Application):
+    """
+    Запускает фоновые задачи бота, когда у приложения уже есть event loop.
+
+    :param application: приложение Telegram
+    :type application: Application
+    """
+    write_queue = asyncio.Queue()
+    application.bot_data["write_queue"] = write_queue
+    application.bot_data["db_writer"] = asyncio.create_task(
+        run_db_writer(application.bot_data["db_conn"], write_queue)
+    )
+    application.bot_data["db_maintenance"] = asyncio.create_task(
+        maintain_database(application.bot_data["db_conn"])
+    )
+
+
+async def stop_background_tasks(application: Application):
+    """
+    Останавливает фоновые задачи, дав им дописать в БД то, что осталось в очереди.
+
+    :param application: приложение Telegram
+    :type application: Application
+    """
+    application.bot_data["db_maintenance"].cancel()
+    await application.bot_data["write_queue"].join()
+    application.bot_data["db_writer"].cancel()
+
+
 def main():
     """
     Основная функция запуска бота.
@@ -1542,11 +2503,18 @@ def main():
         )
 
     db_connection = init_db()
+    open_read_pool()
 
     # Новый способ конфигурации клиента
     client = genai.Client(api_key=GEMINI_API_KEY)
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(start_background_tasks)
+        .post_shutdown(stop_background_tasks)
+        .build()
+    )
 
     application.bot_data["db_conn"] = db_connection
     application.bot_data["gemini_client"] = client
@@ -1559,6 +2527,7 @@ def main():
     logger.info("Бот запускается...")
     application.run_polling()
 
+    close_read_pool()
     db_connection.close()
     logger.info("Соединение с БД закрыто.")
 
@@ -2,7 +2,8 @@
 Модуль для разделения больших HTML-сообщений для Telegram.
 
 Предоставляет функцию split_html_message(), которая разбивает HTML-строку на фрагменты,
-соблюдая лимиты Telegram и целостность тегов.
+соблюдая лимиты Telegram и целостность тегов, и iter_split_html_message(), которая отдает
+те же фрагменты по одному.
 
 Особенности:
     - Поддерживает только разрешенные в Telegram теги (b, i, u, s, a, code, pre, tg-spoiler).
@@ -16,50 +17,89 @@
 """
 
 import re
+from collections.abc import Iterator
 
 # Теги, поддерживаемые Telegram (остальные будут игнорироваться в стеке, но останутся в тексте)
-ALLOWED_TAGS = {
-    "b",
-    "i",
-    "u",
-    "s",
-    "a",
-    "code",
-    "pre",
-    "tg-spoiler",
-}
+ALLOWED_TAGS = frozenset(
+    {
+        "b",
+        "i",
+        "u",
+        "s",
+        "a",
+        "code",
+        "pre",
+        "tg-spoiler",
+    }
+)
 
 # Теги, которые не требуют закрытия или работают как разрывы
-VOID_TAGS = {"br"}
+VOID_TAGS = frozenset({"br"})
+
+# Находит теги вместе с признаком закрытия и именем, чтобы не разбирать тег второй раз.
+# Лишние "<" и пробелы перед именем пропускаем ("<<b>" - это тег <b>), а имя должно
+# кончаться пробелом, "/" или ">": "<b_x>" или "<i.foo>" - не теги b и i. Имени может
+# и не быть (например, "< 3>"): такой токен все равно тег, но в стек не идет.
+TAG_PATTERN = re.compile(
+    r"<(?=[^>])(?:[<\s]*(/)?\s*([A-Za-z][A-Za-z0-9-]*)(?=[\s/>]))?[^>]*>"
+)
 
 
 def get_closing_str(stack):
     """Генерирует строку закрывающих тегов для текущего стека."""
-    return "".join(f"</{tag_name}>" for tag_name, _ in reversed(stack))
+    return "".join(closing_tag for _, _, closing_tag in reversed(stack))
 
 
 def get_opening_str(stack):
     """Генерирует строку открывающих тегов для начала следующего чанка."""
-    return "".join(full_tag for _, full_tag in stack)
-
-
-def extract_tag_info(token):
-    """Возвращает (имя_тега, is_closing, is_void)."""
-    clean = token.strip("<> ")
-    is_closing = clean.startswith("/")
-    if is_closing:
-        clean = clean[1:]
+    return "".join(full_tag for _, full_tag, _ in stack)
 
-    # Берем первое слово (имя тега)
-    tag_name = clean.split()[0].lower()
-    is_void = tag_name in VOID_TAGS or clean.endswith("/")
 
-    return tag_name, is_closing, is_void
+def iter_tokens(html):
+    """
+    Разбирает HTML за один проход регулярки.
 
+    Выдает кортежи (токен, имя_тега, is_closing, is_void). У текста имя_тега - None,
+    у тега без имени - пустая строка.
+    """
+    last_end = 0
+    for match in TAG_PATTERN.finditer(html):
+        start = match.start()
+        if start > last_end:
+            yield html[last_end:start], None, False, False
+        token = match.group(0)
+        raw_name = match.group(2)
+        tag_name = raw_name.lower() if raw_name else ""
+        is_void = tag_name in VOID_TAGS or token.rstrip("> ").endswith("/")
+        yield token, tag_name, bool(raw_name and match.group(1)), is_void
+        last_end = match.end()
+    if last_end < len(html):
+        yield html[last_end:], None, False, False
+
+
+def split_plain_text(text, max_chars):
+    """
+    Режет текст без тегов так же, как split_html_message, но без стека тегов.
 
-def split_html_message(  # pylint: disable=too-many-locals,too-many-branches
-    html: str, max_chars: int = 4096
-) -> list[str]:
+    Приоритет разреза тот же: последний перенос строки, затем последний пробел, иначе
+    жестко по лимиту. Разделитель остается в конце куска.
+    """
+    chunks = []
+    start = 0
+    while len(text) - start > max_chars:
+        end = start + max_chars
+        split_idx = text.rfind("\n", start, end)
+        if split_idx == -1:
+            split_idx = text.rfind(" ", start, end)
+        split_idx = end if split_idx == -1 else split_idx + 1
+        chunks.append(text[start:split_idx])
+        start = split_idx
+    if start < len(text):
+        chunks.append(text[start:])
+    return chunks
+
+
+def split_html_message(html: str, max_chars: int = 4096) -> list[str]:
     """
     Разбивает HTML-сообщение на части не длиннее max_chars.
 
@@ -77,113 +117,146 @@ def split_html_message(  # pylint: disable=too-many-locals,too-many-branches
     Возвращает:
         Список строк (чанков).
     """
-    if len(html) <= max_chars:
-        return [html]
+    return list(iter_split_html_message(html, max_chars))
 
-    # Разбиваем на теги и текст. Группировка () сохраняет разделители в списке.
-    tokens = re.split(r"(<[^>]+>)", html)
-
-    chunks = []
-    current_chunk = ""
-    # Стек хранит кортежи: (имя_тега, полный_текст_открывающего_тега)
-    # Пример: ('a', '<a href="google.com">')
-    tag_stack = []
 
-    for token in tokens:  # pylint: disable=too-many-nested-blocks
-        if not token:
-            continue
+def iter_split_html_message(html: str, max_chars: int = 4096) -> Iterator[str]:
+    """
+    То же, что split_html_message, но отдает чанки по одному, как только они готовы.
 
+    Удобно, когда чанки сразу отправляются: в памяти не копится весь список.
+    """
+    if len(html) <= max_chars:
+        yield html
+        return
+    # Без тегов стек не понадобится: обычный текст режем напрямую
+    if "<" not in html:
+        yield from split_plain_text(html, max_chars)
+        return
+    # Пустые чанки (иногда возникают из-за переносов) не отдаем
+    yield from filter(None, iter_html_chunks(html, max_chars))
+
+
+def iter_html_chunks(  # pylint: disable=too-many-locals,too-many-branches,too-many-statements
+    html, max_chars
+):
+    """Основной цикл разбиения: отдает чанки по мере закрытия, в том числе пустые."""
+    # Текущий чанк копим списком кусков и склеиваем один раз, когда он готов: сложение
+    # строк копировало бы весь чанк заново на каждом токене. Длину считаем отдельно.
+    current_parts = []
+    current_len = 0
+    # Стек хранит кортежи: (имя_тега, полный_текст_открывающего_тега, закрывающий_тег)
+    # Пример: ('a', '<a href="google.com">', '</a>')
+    tag_stack = []
+    # Открывающие и закрывающие теги стека держим готовыми строками и пересобираем, только
+    # когда стек меняется: текст режется много чаще, чем открываются и закрываются теги.
+    opening_markup = ""
+    closing_markup = ""
+    allowed_tags = ALLOWED_TAGS
+
+    # pylint: disable-next=too-many-nested-blocks
+    for token, tag_name, is_closing, is_void in iter_tokens(html):
         # --- Логика обработки ТЕГОВ ---
-        if token.startswith("<"):
-            tag_name, is_closing, is_void = extract_tag_info(token)
-
-            # Рассчитываем длину закрывающего хвоста
-            closing_markup = get_closing_str(tag_stack)
-
+        if tag_name is not None:
             # Проверяем, влезает ли тег в текущий чанк
-            if len(current_chunk) + len(token) + len(closing_markup) > max_chars:
+            if current_len + len(token) + len(closing_markup) > max_chars:
                 # Тег не влезает. Закрываем текущий чанк.
-                chunks.append(current_chunk + closing_markup)
+                current_parts.append(closing_markup)
+                yield "".join(current_parts)
                 # Начинаем новый.
-                current_chunk = get_opening_str(tag_stack)
+                current_parts = [opening_markup]
+                current_len = len(opening_markup)
                 # Если даже в новый пустой чанк тег не влезает (экстремально мало места)
                 # то это патология, но мы добавим его, чтобы не потерять контент.
 
-            current_chunk += token
+            current_parts.append(token)
+            current_len += len(token)
 
             # Обновляем стек, если тег структурный и разрешенный
-            if tag_name in ALLOWED_TAGS:
+            if tag_name in allowed_tags:
                 if is_closing:
                     # Пытаемся закрыть последний соответствующий тег
                     # Ищем с конца, чтобы закрыть ближайший (хотя HTML должен быть валидным)
                     for tg in range(len(tag_stack) - 1, -1, -1):
                         if tag_stack[tg][0] == tag_name:
                             tag_stack.pop(tg)
+                            # Закрыться мог тег из середины стека - пересобираем целиком
+                            opening_markup = get_opening_str(tag_stack)
+                            closing_markup = get_closing_str(tag_stack)
                             break
                 elif not is_void:
                     # Открывающий тег - добавляем в стек
-                    tag_stack.append((tag_name, token))
+                    closing_tag = f"</{tag_name}>"
+                    tag_stack.append((tag_name, token, closing_tag))
+                    opening_markup += token
+                    closing_markup = closing_tag + closing_markup
 
             continue
 
         # --- Логика обработки ТЕКСТА ---
+        # Идем по тексту смещением pos, а не отрезаем обработанное начало: иначе длинный
+        # абзац копировался бы заново на каждом разрезе.
         text = token
-        while text:
-            closing_markup = get_closing_str(tag_stack)
+        text_len = len(text)
+        pos = 0
+        while pos < text_len:
             # Сколько места осталось для чистого текста
-            available_space = max_chars - len(current_chunk) - len(closing_markup)
+            available_space = max_chars - current_len - len(closing_markup)
 
-            if len(text) <= available_space:
-                current_chunk += text
-                text = ""  # Весь текст добавлен
+            if text_len - pos <= available_space:
+                current_parts.append(text[pos:] if pos else text)
+                current_len += text_len - pos
+                pos = text_len  # Весь текст добавлен
             else:
                 # Текст не влезает целиком. Нужно резать.
-                # Ищем лучшее место для разреза в пределах available_space
-
-                # Срез, который теоретически влезает
-                candidate = text[:available_space]
+                # Ищем лучшее место для разреза в пределах available_space. Границу
+                # передаем в rfind, а не режем срез: копия куска для поиска не нужна.
+                # Отрицательный остаток, как и у среза, отсчитывается от конца текста.
+                if available_space >= 0:
+                    limit = pos + available_space
+                else:
+                    limit = max(pos, text_len + available_space)
 
                 # Приоритет 1: Перенос строки (ищем последний \n)
-                split_idx = candidate.rfind("\n")
+                split_idx = text.rfind("\n", pos, limit)
 
                 # Приоритет 2: Пробел (если нет переноса, ищем последний пробел)
                 if split_idx == -1:
-                    split_idx = candidate.rfind(" ")
+                    split_idx = text.rfind(" ", pos, limit)
 
                 # Если вообще нет разделителей (очень длинное слово), режем жестко
                 if split_idx == -1:
                     # Но если available_space слишком мал (меньше 10 символов),
                     # лучше сразу перенести всё слово на новый чанк, если чанк не пустой
-                    if available_space < 10 and len(current_chunk) > len(
-                        get_opening_str(tag_stack)
-                    ):
+                    if available_space < 10 and current_len > len(opening_markup):
                         split_idx = -1  # Сигнал "закрывай текущий чанк"
                     else:
                         split_idx = available_space
                 else:
                     # Включаем разделитель в текущий кусок (или +1 если хотим выкинуть?)
                     # Обычно пробел оставляют в конце строки или убирают.
-                    # text[:split_idx] берет до пробела.
-                    # Чтобы пробел остался на этой строке: split_idx + 1
-                    split_idx += 1
+                    # Найденная позиция абсолютная, а длина куска - от pos.
+                    # Чтобы пробел остался на этой строке: + 1
+                    split_idx += 1 - pos
 
                 if split_idx > 0:
                     # Добавляем часть текста
-                    current_chunk += text[:split_idx]
-                    text = text[split_idx:]
+                    current_parts.append(text[pos : pos + split_idx])
+                    current_len += split_idx
+                    pos += split_idx
 
                 # Закрываем чанк
-                chunks.append(current_chunk + closing_markup)
+                current_parts.append(closing_markup)
+                yield "".join(current_parts)
 
                 # Начинаем новый чанк
-                current_chunk = get_opening_str(tag_stack)
+                current_parts = [opening_markup]
+                current_len = len(opening_markup)
 
     # Добавляем последний чанк, если есть
-    if current_chunk:
-        chunks.append(current_chunk + get_closing_str(tag_stack))
-
-    # Фильтрация пустых чанков (иногда возникают из-за переносов)
-    return [c for c in chunks if c and c != get_opening_str([])]
+    if current_len:
+        current_parts.append(closing_markup)
+        yield "".join(current_parts)
 
 
 if __name__ == "__main__":
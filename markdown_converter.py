@@ -3,17 +3,23 @@
 Функции:
 - markdown_to_telegram_html(md): превращает Markdown в HTML, совместимый с ограниченным
 набором тегов Telegram.
-- clean_for_telegram(soup): очищает дерево от неподдерживаемых тегов и небезопасных атрибутов.
+- clean_for_telegram(html): убирает неподдерживаемые теги и небезопасные атрибуты.
 
 Особенности:
-- Списки (<ul>/<ol>) разворачиваются в текст с маркерами (•) или нумерацией.
-- Параграфы <p> заменяются на двойные переводы строк.
+- Списки разворачиваются в текст с маркерами (•) или нумерацией.
+- Параграфы и заголовки отделяются двойными переводами строк.
+- Таблицы превращаются в строки с ячейками через " | ".
 - Поддерживаются только теги: b, i, u, s, a, code, pre, br, tg-spoiler.
 - Атрибуты сохраняются только для ссылок (href).
+- Промежуточный HTML не строим: HTML для Telegram пишется прямо по потоку токенов
+  markdown-it. Чистить регулярками приходится только сырой HTML из самого текста.
 """
 
-from bs4 import BeautifulSoup
-from markdown import markdown
+import re
+from html import escape, unescape
+
+from markdown_it import MarkdownIt
+from markdown_it.token import Token
 
 ALLOWED_TAGS = {"b", "i", "u", "s", "a", "code", "pre", "br", "tg-spoiler"}
 TELEGRAM_TAG_MAP = {
@@ -31,54 +37,199 @@ TELEGRAM_TAG_MAP = {
     "tg-spoiler": "tg-spoiler",
 }
 
+# Парсер собираем один раз. Состояние разбора живет в самом вызове parse(), поэтому
+# один экземпляр можно звать сколько угодно раз.
+MARKDOWN_PARSER = MarkdownIt("commonmark").enable(["table", "strikethrough"])
 
-def clean_for_telegram(soup: BeautifulSoup) -> BeautifulSoup:
-    """Оставляет только разрешённые Telegram HTML-теги и очищает атрибуты."""
-    for tag in soup.find_all(True):
-        if tag.name not in ALLOWED_TAGS:
-            tag.unwrap()
-        else:
-            if tag.name == "a":
-                href = tag.get("href", "")
-                tag.attrs = {"href": href}
-            else:
-                tag.attrs = {}
-    return soup
+# Токены разметки внутри строки, которые прямо переводятся в теги Telegram: открывающий
+# токен -> тег и закрывающий токен -> тег. Ссылка открывается отдельно, у нее есть href.
+INLINE_OPEN_TAGS = {"strong_open": "b", "em_open": "i", "s_open": "s"}
+INLINE_CLOSE_TAGS = {
+    "strong_close": "b",
+    "em_close": "i",
+    "s_close": "s",
+    "link_close": "a",
+}
+# Переносы строк Telegram понимает как есть, тег <br> для них не нужен.
+LINE_BREAK_TOKENS = {"softbreak", "hardbreak"}
+LIST_OPEN_TOKENS = {"bullet_list_open", "ordered_list_open"}
+LIST_CLOSE_TOKENS = {"bullet_list_close", "ordered_list_close"}
+BLOCK_CLOSE_TOKENS = {"paragraph_close", "heading_close"}
 
+# Тег из сырого HTML: имя обязательно кончается пробелом, "/" или ">", а внутри нет
+# других угловых скобок. Иначе "a<b then" или "<b_x>" приняли бы за тег <b>.
+TAG_PATTERN = re.compile(r"<(/)?([A-Za-z][A-Za-z0-9-]*)(?=[\s/>])([^<>]*)>")
+HREF_PATTERN = re.compile(r"""\bhref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""", re.I)
 
-def markdown_to_telegram_html(md: str) -> str:
-    """Конвертирует Markdown в безопасный HTML для Telegram."""
-    raw_html = markdown(md, extensions=["fenced_code", "tables"])
-    soup = BeautifulSoup(raw_html, "html.parser")
-
-    # Преобразуем списки в текст
-    for ul in soup.find_all(["ul", "ol"]):
-        is_ordered = ul.name == "ol"
-        idx = 1
-        lines = []
-        for li in ul.find_all("li", recursive=False):
-            text = "".join(str(c) for c in li.contents)
-            if is_ordered:
-                lines.append(f"{idx}. {text}")
-            else:
-                lines.append(f"• {text}")
-            idx += 1
-        ul.replace_with(BeautifulSoup("\n".join(lines), "html.parser"))
 
-    # Убираем <p>, заменяя на переносы
-    for p in soup.find_all("p"):
-        p.insert_before("\n\n")
-        p.unwrap()
+def close_tag(tag_name: str, open_tags: list[str]) -> str:
+    """Закрывает тег из стека вместе со всем, что открыто внутри; тег без пары - ничего."""
+    if tag_name not in open_tags:
+        return ""
+    closers = []
+    while True:
+        name = open_tags.pop()
+        closers.append(f"</{name}>")
+        if name == tag_name:
+            return "".join(closers)
+
+
+def rewrite_tag(match: re.Match, open_tags: list[str]) -> str:
+    """
+    Переводит тег в тег Telegram, а неподдерживаемый убирает, оставляя содержимое.
+
+    open_tags - стек открытых тегов Telegram: закрывающий тег без пары выкидывается, а
+    закрывающий тег снаружи закрывает и все, что открыто внутри него.
+    """
+    raw_name = match.group(2).lower()
+    if raw_name == "p":
+        # Параграф превращается в перенос перед ним, закрывающий тег просто уходит
+        return "" if match.group(1) else "\n\n"
+    tag_name = TELEGRAM_TAG_MAP.get(raw_name)
+    if tag_name not in ALLOWED_TAGS:
+        return ""
+    if tag_name == "br":
+        return "" if match.group(1) else "<br/>"
+    if match.group(1):
+        return close_tag(tag_name, open_tags)
+    open_tags.append(tag_name)
+    if tag_name == "a":
+        href = HREF_PATTERN.search(match.group(3))
+        value = next((v for v in href.groups() if v is not None), "") if href else ""
+        return f'<a href="{escape(unescape(value))}">'
+    return f"<{tag_name}>"
+
+
+def rewrite_raw_html(html: str, open_tags: list[str]) -> str:
+    """
+    Чистит сырой HTML: теги - через rewrite_tag, весь остальной текст экранируется.
+
+    Сущности в тексте сначала раскрываются, чтобы "&amp;" не превратился в "&amp;amp;".
+    """
+    out = []
+    last_end = 0
+    for match in TAG_PATTERN.finditer(html):
+        out.append(escape(unescape(html[last_end : match.start()]), quote=False))
+        out.append(rewrite_tag(match, open_tags))
+        last_end = match.end()
+    out.append(escape(unescape(html[last_end:]), quote=False))
+    return "".join(out)
+
 
-    # Маппим поддерживаемые теги
-    for tag in soup.find_all(True):
-        if tag.name in TELEGRAM_TAG_MAP:
-            tag.name = TELEGRAM_TAG_MAP[tag.name]
+def close_open_tags(open_tags: list[str]) -> str:
+    """Закрывает все, что осталось открытым, и опустошает стек."""
+    closers = "".join(f"</{name}>" for name in reversed(open_tags))
+    open_tags.clear()
+    return closers
 
-    # Фильтрация для Telegram
-    soup = clean_for_telegram(soup)
 
-    return str(soup).strip()
+def clean_for_telegram(html: str) -> str:
+    """
+    Оставляет только разрешённые Telegram HTML-теги и очищает атрибуты, <p> - переносы.
+
+    Текст вне тегов экранируется, незакрытые теги закрываются в конце: Telegram не
+    примет ни голую "<", ни разбалансированную разметку.
+    """
+    open_tags = []
+    return rewrite_raw_html(html, open_tags) + close_open_tags(open_tags)
+
+
+def render_inline(children: list[Token], out: list[str]):
+    """
+    Дописывает в out содержимое строки: текст, код, ссылки и выделение.
+
+    Теги из разметки и из сырого HTML внутри строки делят один стек: так сырой "</b>"
+    не перехлестнется с курсивом из Markdown, а все незакрытое закроется в конце строки.
+    """
+    open_tags = []
+    for child in children:
+        kind = child.type
+        if kind == "text":
+            if child.content:
+                out.append(escape(child.content, quote=False))
+        elif kind in INLINE_OPEN_TAGS:
+            tag_name = INLINE_OPEN_TAGS[kind]
+            open_tags.append(tag_name)
+            out.append(f"<{tag_name}>")
+        elif kind in INLINE_CLOSE_TAGS:
+            out.append(close_tag(INLINE_CLOSE_TAGS[kind], open_tags))
+        elif kind in LINE_BREAK_TOKENS:
+            out.append("\n")
+        elif kind == "code_inline":
+            out.append(f"<code>{escape(child.content, quote=False)}</code>")
+        elif kind == "link_open":
+            open_tags.append("a")
+            out.append(f'<a href="{escape(child.attrGet("href") or "")}">')
+        elif kind == "image":
+            # Картинку Telegram в тексте не покажет, оставляем ее подпись
+            if child.content:
+                out.append(escape(child.content, quote=False))
+        elif kind == "html_inline":
+            # Сырой HTML модели: текст в нем экранируется, лишние теги выкидываются
+            out.append(rewrite_raw_html(child.content, open_tags))
+    out.append(close_open_tags(open_tags))
+
+
+def start_line(out: list[str]):
+    """Переносит вывод на новую строку, если он сейчас не в ее начале."""
+    if out and not out[-1].endswith("\n"):
+        out.append("\n")
+
+
+def markdown_to_telegram_html(md: str) -> str:  # pylint: disable=too-many-branches
+    """Конвертирует Markdown в безопасный HTML для Telegram."""
+    out = []
+    # Открытые списки: следующий номер пункта, у маркированного - None
+    lists = []
+    # Ячеек уже выведено в текущей строке таблицы
+    cells = 0
+
+    for token in MARKDOWN_PARSER.parse(md):
+        kind = token.type
+        # Блок внутри списка заканчивается переносом, снаружи - пустой строкой
+        block_end = "\n" if lists else "\n\n"
+        if kind == "inline":
+            render_inline(token.children or [], out)
+        elif kind in BLOCK_CLOSE_TOKENS:
+            # В плотном списке параграфы скрыты: пункт и так занимает одну строку
+            if not token.hidden:
+                out.append(block_end)
+        elif kind in LIST_OPEN_TOKENS:
+            ordered = kind == "ordered_list_open"
+            lists.append(int(token.attrGet("start") or 1) if ordered else None)
+        elif kind in LIST_CLOSE_TOKENS:
+            lists.pop()
+            if not lists:
+                out.append("\n")
+        elif kind == "list_item_open":
+            # Вложенный список идет сразу за текстом пункта: переносим его на новую строку
+            start_line(out)
+            if lists[-1] is None:
+                out.append("• ")
+            else:
+                out.append(f"{lists[-1]}. ")
+                lists[-1] += 1
+        elif kind == "list_item_close":
+            start_line(out)
+        elif kind in ("fence", "code_block"):
+            start_line(out)
+            out.append(f"<pre><code>{escape(token.content, quote=False)}</code></pre>")
+            out.append(block_end)
+        elif kind == "html_block":
+            # Сырой HTML модели целым блоком: экранируем текст и закрываем его теги
+            out.append(clean_for_telegram(token.content))
+        elif kind == "tr_open":
+            cells = 0
+        elif kind in ("th_open", "td_open"):
+            if cells:
+                out.append(" | ")
+            cells += 1
+        elif kind == "tr_close":
+            out.append("\n")
+        elif kind == "table_close":
+            out.append(block_end[1:])
+
+    return "".join(out).strip()
 
 
 if __name__ == "__main__":